@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+""" Measure the cold start of the nginx runner: a bare interpreter, an
+    import of the runner as a library and a `--list` of the suites.
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+import subprocess
+
+
+runner = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      'ztest_nginx.py')
+commands = [
+    ('python', [sys.executable, '-c', 'pass']),
+    ('import', [sys.executable, '-c',
+                'import sys; sys.path.insert(0, %r); import ztest_nginx' %
+                os.path.dirname(runner)]),
+    ('list', [sys.executable, runner, '--list']),
+]
+
+
+def bench(args, rounds):
+    samples = []
+    with open(os.devnull, 'w') as devnull:
+        for _ in range(rounds):
+            start = time.time()
+            subprocess.check_call(args, stdout=devnull)
+            samples.append((time.time() - start) * 1000)
+    samples.sort()
+    return samples[0], samples[len(samples) // 2], samples[-1]
+
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    print('%-8s %10s %10s %10s' % ('', 'min ms', 'median ms', 'max ms'))
+    for name, args in commands:
+        print('%-8s %10.1f %10.1f %10.1f' % ((name,) + bench(args, rounds)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+    pytest_ztest
+    ~~~~~~~~~~~~
+
+    A pytest plugin running .zt files through ztest_nginx, enabled with
+    examples/ on the path:
+
+        PYTHONPATH=examples py.test -p pytest_ztest t/nginx -n auto
+
+    Collection parses the files, a name used by several cases of a file
+    gets their line numbers appended to stay a distinct node id. Every
+    pytest-xdist worker runs its own nginx, under its own prefix and on
+    its own port.
+"""
+
+import os
+import unittest
+
+import pytest
+
+import ztest_nginx
+from ztest_nginx import TestNginx, Nginx, Fixtures, FileSuite, \
+    MatrixCases, add_test_case, load_test_file, normalize_name, spawn, \
+    LOG_ERR
+
+# ports of a worker are nginx_api and nginx_batch_port shifted by this
+# much per worker, it must exceed nginx_batch_size
+port_stride = 100
+
+
+def make_node(cls, parent, **kwargs):
+    if hasattr(cls, 'from_parent'):
+        return cls.from_parent(parent, **kwargs)
+    return cls(parent=parent, **kwargs)
+
+
+def worker_index(config):
+    workerinput = getattr(config, 'workerinput', None)
+    if workerinput is None:
+        return None
+    return int(workerinput['workerid'].lstrip('gw'))
+
+
+class Worker(object):
+    """ The nginx prefix and api of this process and the fixtures shared
+        by its files, a pytest-xdist worker gets its own.
+    """
+    def __init__(self, config):
+        self.index = worker_index(config)
+        if self.index is not None:
+            offset = port_stride * (self.index + 1)
+            host, port = ztest_nginx.nginx_api.rsplit(':', 1)
+            TestNginx.nginx_prefix = '%s-gw%d' % (TestNginx.nginx_prefix,
+                                                  self.index)
+            TestNginx.api = '%s:%d' % (host, int(port) + offset)
+            ztest_nginx.nginx_batch_port += offset
+        self.prefix = TestNginx.nginx_prefix
+        self.api = TestNginx.api
+        self.fixtures = Fixtures()
+
+    def close(self):
+        errors = self.fixtures.close()
+        Nginx(self.prefix, TestNginx.nginx_bin).stop()
+        return errors
+
+
+def get_worker(config):
+    if getattr(config, '_ztest_worker', None) is None:
+        config._ztest_worker = Worker(config)
+    return config._ztest_worker
+
+
+@pytest.fixture(scope='session')
+def ztest_worker(request):
+    """ The `Worker` of this process, for Python tests next to the .zt
+        files.
+    """
+    return get_worker(request.config)
+
+
+def pytest_unconfigure(config):
+    worker = getattr(config, '_ztest_worker', None)
+    if worker is not None:
+        for exc_info in worker.close():
+            LOG_ERR('fixture teardown failed: %s' % exc_info[1])
+
+
+def pytest_collect_file(path, parent):
+    if path.ext == '.zt':
+        return make_node(ZtFile, parent, fspath=path)
+
+
+class ZtFailure(Exception):
+    def __init__(self, problems):
+        super(ZtFailure, self).__init__(problems)
+        self.problems = problems
+
+
+class ZtFile(pytest.File):
+    """ A .zt file, its env and setup run before its first case. """
+    def collect(self):
+        _, _, cases = load_test_file(os.path.relpath(str(self.fspath)))
+        names = [normalize_name(c.template.name) if isinstance(
+            c, MatrixCases) else c.name for c in cases]
+        for name, case in zip(names, cases):
+            if names.count(name) > 1:
+                name = '%s@%d' % (name, case.lineno)
+            yield make_node(ZtItem, self, name=name, lineno=case.lineno)
+
+    def setup(self):
+        worker = get_worker(self.config)
+        self.zt = os.path.relpath(str(self.fspath))
+        g, options, self.cases = load_test_file(self.zt)
+        self.env = {'TestNginx': TestNginx, 'spawn': spawn}
+        self.suite = FileSuite(self.zt, g, self.env, options=options,
+                               fixtures=worker.fixtures)
+        self.check(self.suite.setup)
+
+    def teardown(self):
+        suite = getattr(self, 'suite', None)
+        if suite is not None:
+            self.suite = None
+            self.check(suite.teardown)
+
+    @staticmethod
+    def check(fn):
+        result = unittest.TestResult()
+        fn(result)
+        if result.errors:
+            raise ZtFailure(result.errors)
+
+
+class ZtItem(pytest.Item):
+    """ A case of a .zt file, or every case generated by a template. """
+    def __init__(self, name, parent, lineno=0, **kwargs):
+        super(ZtItem, self).__init__(name, parent, **kwargs)
+        self.lineno = lineno
+
+    def runtest(self):
+        zt = self.parent
+        cases = [c for c in zt.cases if c.lineno == self.lineno]
+        if not cases:
+            raise Exception('no test case at line %d' % self.lineno)
+
+        suite = unittest.TestSuite()
+        add_test_case(zt.zt, suite, cases, zt.env, g=zt.suite.g)
+        result = unittest.TestResult()
+        suite.run(result)
+        if result.errors or result.failures:
+            raise ZtFailure(result.errors + result.failures)
+        if result.skipped:
+            pytest.skip(result.skipped[0][1])
+
+    def repr_failure(self, excinfo):
+        if isinstance(excinfo.value, ZtFailure):
+            return '\n'.join('%s\n%s' % (test, tb)
+                             for test, tb in excinfo.value.problems)
+        return super(ZtItem, self).repr_failure(excinfo)
+
+    def reportinfo(self):
+        return self.fspath, self.lineno - 1, '%s:%d: %s' % (
+            self.parent.fspath.basename, self.lineno, self.name)
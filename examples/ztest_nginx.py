@@ -6,15 +6,22 @@ import re
 import sys
 import time
 import copy
+import json
+import math
+import hashlib
+import itertools
+import signal
+import socket
 import logging
+import threading
+import traceback
 import unittest
-import requests
-import subprocess
-from subprocess import Popen, PIPE
+import contextlib
 
 sys.path.append(os.path.expandvars('$PWD'))
 
-from ztest import Lexer, Cases, ContextTestCase
+from ztest import Lexer, Cases, ContextTestCase, ContextSuite, Fragments, \
+    Template, intern_table
 
 
 __version__ = "0.0.3"
@@ -30,6 +37,35 @@ test_directory = 't/nginx'
 openresty_root = '/usr/local/openresty/nginx'
 nginx_error_log = 't/nginx/servroot/logs/error.log'
 nginx_api = '127.0.0.1:1984'
+nginx_batch_port = 1990
+nginx_batch_size = 64
+stream_chunk_size = 64 * 1024
+stream_match_max = 4096
+cache_file = '.ztest_cache'
+# run modes that change what a passing case has checked
+cache_modes = ['ZTEST_CHECK_LEAK', 'ZTEST_CHECK_LEAK_ROUNDS',
+               'ZTEST_CHECK_LEAK_KB', 'ZTEST_CHECK_LEAK_WARMUP',
+               'ZTEST_REPEAT_EACH', 'ZTEST_SSL', 'ZTEST_UNIX', 'ZTEST_BATCH',
+               'ZTEST_USAGE', 'ZTEST_BENCH']
+socket_timeout = 10
+shell_timeout = 60
+bench_file = '.ztest_bench.jsonl'
+bench_tolerance = {'latency_ms': 0.1, 'throughput': 0.1, 'cpu_ms': 0.2,
+                   'rss_kb': 0.1}
+bench_min_delta = {'latency_ms': 1.0, 'throughput': 0.0, 'cpu_ms': 20,
+                   'rss_kb': 1024}
+bench_alpha = 0.05
+bench_min_samples = 5
+leak_rounds = 200
+leak_warmup = 0.2
+leak_threshold_kb = 1024
+daemon_socket = '.ztest.sock'
+compile_cache_size = 4096
+pattern_cache_size = 1024
+tls_dir = '.ztest_tls'
+# sun_path holds 108 bytes with the trailing NUL
+unix_path_max = 107
+tls_days = 3650
 nginx_template = '''
 worker_processes  1;
 
@@ -46,18 +82,241 @@ http {
 
     sendfile        on;
     keepalive_timeout  65;
-
+%(servers)s
+}
+'''
+nginx_server_template = '''
     server {
-        listen       1984;
+        listen       %(listen)s;
         server_name  localhost;
-
+%(ssl)s
 %(config)s
     }
-}
 '''
+nginx_ssl_template = '''
+        ssl_certificate      %(cert)s;
+        ssl_certificate_key  %(key)s;
+        ssl_session_cache    shared:ztest:1m;
+        ssl_session_tickets  on;
+'''
+
+
+def unix_dir(prefix, create=True):
+    """ The directory of the Unix sockets of the nginx under `prefix`, a
+        short one in the temp dir as socket paths must fit sun_path.
+    """
+    import tempfile
+
+    directory = os.path.join(tempfile.gettempdir(), 'ztest-%s' % hashlib.sha1(
+        os.path.abspath(prefix)).hexdigest()[:12])
+    if create:
+        try:
+            os.mkdir(directory, 0o700)
+        except OSError:
+            if os.stat(directory).st_uid != os.getuid():
+                raise Exception('%s is not ours' % directory)
+    return directory
+
+
+def unix_api(prefix, name='nginx'):
+    """ A Unix socket of the nginx under `prefix`, the address is both the
+        runner's api and the nginx listen address.
+    """
+    path = os.path.join(unix_dir(prefix), name + '.sock')
+    if len(path) > unix_path_max:
+        raise Exception('unix socket path longer than %d bytes: %s' % (
+            unix_path_max, path))
+    return 'unix:' + path
+
+
+def listen_address(api):
+    if api.startswith('unix:'):
+        return api
+    return api.rsplit(':', 1)[1]
+
+
+def tls_files(directory=tls_dir):
+    """ Return the paths of a local CA certificate and of a server
+        certificate and key it signed for localhost and 127.0.0.1. They
+        are generated with openssl once and kept in `directory`.
+    """
+    names = ['ca.crt', 'server.crt', 'server.key']
+    files = [os.path.abspath(os.path.join(directory, n)) for n in names]
+    if all(os.path.isfile(f) for f in files):
+        return files
+
+    import shutil
+    import tempfile
+    from subprocess import Popen, PIPE, STDOUT
+
+    # concurrent runners generate their own and keep the first one
+    target = os.path.abspath(directory)
+    tmp = tempfile.mkdtemp(prefix='.ztest-tls-',
+                           dir=os.path.dirname(target))
+    try:
+        open(os.path.join(tmp, 'server.ext'), 'w').write(
+            'subjectAltName = DNS:localhost, IP:127.0.0.1\n')
+        for command in [
+                'openssl req -x509 -newkey rsa:2048 -nodes -days %d '
+                '-subj /CN=ztest-ca -addext basicConstraints=critical,CA:TRUE '
+                '-keyout ca.key -out ca.crt' % tls_days,
+                'openssl req -newkey rsa:2048 -nodes -subj /CN=localhost '
+                '-keyout server.key -out server.csr',
+                'openssl x509 -req -in server.csr -CA ca.crt -CAkey ca.key '
+                '-CAcreateserial -days %d -extfile server.ext '
+                '-out server.crt' % tls_days]:
+            p = Popen(command.split(), cwd=tmp, stdout=PIPE, stderr=STDOUT)
+            out = p.communicate()[0]
+            if p.returncode != 0:
+                raise Exception('%s failed:\n%s' % (command, out))
+        try:
+            os.rename(tmp, target)
+        except OSError:
+            if not all(os.path.isfile(f) for f in files):
+                raise
+    finally:
+        if os.path.isdir(tmp):
+            shutil.rmtree(tmp)
+    return files
+
+
+_tls = {}
+
+
+def tls_wrap(sock):
+    """ Wrap `sock` in TLS trusting the local CA, resuming the last
+        session where the ssl module supports it.
+    """
+    import ssl
+
+    if 'context' not in _tls:
+        _tls['context'] = ssl.create_default_context(cafile=tls_files()[0])
+    kwargs = {}
+    if _tls.get('session') is not None:
+        kwargs['session'] = _tls['session']
+    sock = _tls['context'].wrap_socket(sock, server_hostname='localhost',
+                                       **kwargs)
+    if getattr(sock, 'session', None) is not None:
+        _tls['session'] = sock.session
+    return sock
+
+
+def tls_client():
+    """ The requests session of the TLS cases, trusting the local CA. Its
+        connections are kept until nginx loads a config, the cases of a
+        batch share them.
+    """
+    if _tls.get('client') is None:
+        import requests
+
+        client = requests.Session()
+        client.verify = tls_files()[0]
+        _tls['client'] = client
+    return _tls['client']
+
+
+def close_tls_client():
+    """ Close the kept TLS connections, an nginx worker holding one keeps
+        serving the config it started with.
+    """
+    client = _tls.pop('client', None)
+    if client is not None:
+        client.close()
+
+
+def case_ssl(case):
+    """ Whether `case` runs over TLS, with `--- config ssl` or
+        ZTEST_SSL=1.
+    """
+    return os.environ.get('ZTEST_SSL') == '1' or any(
+        i.name == 'config' and 'ssl' in i.option for i in case.items)
+
+
+def render_server(api, config, ssl=False):
+    listen, extra = listen_address(api), ''
+    if ssl:
+        _, cert, key = tls_files()
+        listen += ' ssl'
+        extra = nginx_ssl_template % {'cert': cert, 'key': key}
+    return nginx_server_template % {'listen': listen, 'ssl': extra,
+                                    'config': config}
+
+
+def render_conf(servers):
+    """ Fill nginx_template with a server block per (api, config, ssl)
+        of `servers`. A template overridden in the older form, with its
+        own server block around %(config)s, takes a single plain server
+        on the default api.
+    """
+    if '%(servers)s' in nginx_template:
+        return nginx_template % {'servers': ''.join(
+            render_server(*server) for server in servers)}
+    if '%(config)s' not in nginx_template:
+        raise Exception('nginx_template has no %(servers)s placeholder')
+    if len(servers) != 1 or servers[0][0] != nginx_api or servers[0][2]:
+        raise Exception('nginx_template with %(config)s in its own server '
+                        'block serves one case on ' + nginx_api + ', '
+                        'batches, ssl, ZTEST_UNIX and pytest-xdist workers '
+                        'need a %(servers)s placeholder')
+    return nginx_template % {'config': servers[0][1]}
+
+
+def connect(api, timeout=socket_timeout):
+    """ Connect to a `host:port` or `unix:path` api. """
+    if not api.startswith('unix:'):
+        host, port = api.rsplit(':', 1)
+        return socket.create_connection((host, int(port)), timeout)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(api[len('unix:'):])
+    except socket.error:
+        sock.close()
+        raise
+    return sock
+
+
+def unix_session(api):
+    """ A requests session sending every request over the `unix:path`
+        api, the host of the URL is only used for the Host header.
+    """
+    import requests
+    from requests.adapters import HTTPAdapter
+    from requests.packages.urllib3.connection import HTTPConnection
+    from requests.packages.urllib3.connectionpool import HTTPConnectionPool
+
+    class Connection(HTTPConnection):
+        def connect(self):
+            timeout = self.timeout
+            if not isinstance(timeout, (int, float)):
+                timeout = None
+            self.sock = connect(api, timeout)
+
+    class Pool(HTTPConnectionPool):
+        ConnectionCls = Connection
+
+    class Adapter(HTTPAdapter):
+        def __init__(self):
+            super(Adapter, self).__init__()
+            self.pool = Pool('localhost')
+
+        def get_connection(self, *args, **kwargs):
+            return self.pool
+
+        get_connection_with_tls_context = get_connection
+
+        def close(self):
+            self.pool.close()
+            super(Adapter, self).close()
+
+    session = requests.Session()
+    session.mount('http://', Adapter())
+    return session
 
 
 def shell(command):
+    from subprocess import Popen, PIPE
+
     if isinstance(command, list):
         command = ' '.join(command)
     process = Popen(
@@ -70,11 +329,21 @@ def shell(command):
 
 
 def system(command):
+    import subprocess
+
     if isinstance(command, list):
         command = ' '.join(command)
     return subprocess.call(command, shell=True, close_fds=True)
 
 
+def spawn(command, timeout=None):
+    """ Start `command` through /bin/sh without waiting for it.
+    """
+    if isinstance(command, list):
+        command = ' '.join(command)
+    return ShellJob(command, timeout)
+
+
 def gather_files(test_dir):
     if os.path.isfile(test_dir):
         return [test_dir] if test_dir.endswith('zt') else []
@@ -114,17 +383,371 @@ def sleep(t=0.1):
     time.sleep(t)
 
 
-def add_test_case(zt, suite, cases, env, run_only=None):
+_loaded = {}
+fragments = Fragments()
+
+
+def file_stamps(paths):
+    stamps = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        stamps.append((st.st_mtime, st.st_size))
+    return stamps
+
+
+def load_test_file(zt, run_only=None):
+    """ Parse `zt`, return its globals, their options and the cases
+        selected by `run_only`, with names normalized. The parsed file is
+        kept until it or a file it includes changes, the cases must not
+        be modified.
+    """
+    hit = _loaded.get(zt)
+    if hit is None or hit[0] != file_stamps([zt] + hit[1]):
+        deps = []
+        stamps = file_stamps([zt])
+        tokens = fragments.expand(Lexer()(open(zt).read()), zt, deps=deps)
+        stamps += file_stamps(deps) or []
+        parser = Cases()
+        g, cases = parser(tokens)
+        parsed = []
+        for case in cases:
+            if case.name is None:
+                case.name = ''
+            if isinstance(case, Template):
+                try:
+                    compile_code(case.matrix.value, 'eval')
+                except SyntaxError as e:
+                    raise Exception('%s:%d: invalid matrix: %s' % (
+                        getattr(case.matrix, 'source', zt),
+                        case.matrix.lineno, e))
+                parsed.append((None, case))
+                continue
+            # run_only matches the name as written
+            name, case.name = case.name, normalize_name(case.name)
+            parsed.append((name, case))
+        hit = _loaded[zt] = (stamps, deps, g, parser.options, parsed, set())
+
+    _, _, g, options, parsed, compiled = hit
+    selected = []
+    for name, case in parsed:
+        if isinstance(case, Template):
+            selected.append(MatrixCases(zt, case, run_only))
+            continue
+        if run_only and not re.search(run_only, name):
+            continue
+        if id(case) not in compiled:
+            precompile(zt, case)
+            compiled.add(id(case))
+        selected.append(case)
+    return g, options, selected
+
+
+_compiled = {}
+
+
+def compile_code(code, mode='exec'):
+    """ Compile embedded Python once per distinct source text. """
+    if not isinstance(code, basestring):
+        return code
+    key = (code, mode)
+    hit = _compiled.get(key)
+    if hit is None:
+        if len(_compiled) >= compile_cache_size:
+            _compiled.clear()
+        hit = _compiled[key] = compile(code, '<string>', mode)
+    return hit
+
+
+_patterns = {}
+
+
+def compile_pattern(pattern):
+    """ Compile the regex of an assertion through a bounded cache. """
+    if not isinstance(pattern, basestring):
+        return pattern
+    hit = _patterns.get(pattern)
+    if hit is None:
+        if len(_patterns) >= pattern_cache_size:
+            _patterns.clear()
+        hit = _patterns[pattern] = re.compile(pattern)
+    return hit
+
+
+class Expected(object):
+    """ The operand of an assertion parsed at load time. Items are copied
+        for every run of a case, their copies share it.
+    """
+    def __init__(self, value):
+        self.value = value
+
+    def __deepcopy__(self, memo):
+        return self
+
+
+def precompile(zt, case):
+    """ Parse the assertion operands of `case` once, so that invalid ones
+        fail the collection. Evaluated items are parsed when they run.
+    """
+    for item in case.items:
+        if item.name not in TestNginx.assert_items or \
+                item.name in TestNginx.exec_items or \
+                'eval' in item.option or 'exec' in item.option:
+            continue
+        try:
+            item.expected = Expected(TestNginx.parse_expected(item))
+        except (re.error, ValueError, TypeError) as e:
+            raise Exception('%s:%d: invalid %s: %s' % (
+                getattr(item, 'source', zt), item.lineno, item.name, e))
+
+
+def normalize_name(name):
+    return re.sub(r'[^.\w]+', '_', name)
+
+
+def case_id(zt, case):
+    return '%s:%s' % (zt, case.name)
+
+
+_digests = {}
+
+
+def value_digest(value):
+    """ sha1 of an item value, memoized by identity: the parser interns
+        values, so a config shared by many cases is hashed once.
+    """
+    hit = _digests.get(id(value))
+    if hit is None or hit[0] is not value:
+        hit = _digests[id(value)] = (value, hashlib.sha1(
+            value.encode('utf-8') if isinstance(value, unicode) else
+            str(value)).hexdigest())
+    return hit[1]
+
+
+def case_fingerprint(zt, case, g, *extra):
+    """ Digest of a case's items and its file's globals, plus `extra`.
+        Items must not have been evaluated yet.
+    """
+    items = [(i.name, i.option, value_digest(i.value)) for i in case.items]
+    text = json.dumps([zt, case.name, items, sorted((g or {}).items())] +
+                      list(extra))
+    return hashlib.sha1(text).hexdigest()
+
+
+def leaking(samples, warmup=leak_warmup, threshold=leak_threshold_kb):
+    """ Return the growth in kB of RSS `samples` when, after the first
+        `warmup` share of them, the last quarter all stay more than
+        `threshold` kB above the level reached at the end of warm-up.
+    """
+    start = int(len(samples) * warmup)
+    tail = samples[start:]
+    if len(tail) < 4:
+        return None
+    base, last = tail[0], tail[-(len(tail) // 4):]
+    if all(s - base > threshold for s in last):
+        return last[-1] - base
+    return None
+
+
+def git_revision():
+    import subprocess
+
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                           stderr=devnull).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    if not samples:
+        return None
+    return samples[min(len(samples) - 1,
+                       max(0, int(math.ceil(p / 100.0 * len(samples))) - 1))]
+
+
+def mann_whitney_p(a, b):
+    """ One-sided p-value of the Mann-Whitney U test that samples `b`
+        tend to be larger than samples `a`, normal approximation with
+        tie correction.
+    """
+    n1, n2 = len(a), len(b)
+    values = sorted([(v, 0) for v in a] + [(v, 1) for v in b])
+    n, ranks, ties, i = n1 + n2, [0.0] * (n1 + n2), 0.0, 0
+    while i < n:
+        j = i
+        while j + 1 < n and values[j + 1][0] == values[i][0]:
+            j += 1
+        for k in range(i, j + 1):
+            ranks[k] = (i + j) / 2.0 + 1
+        t = j - i + 1
+        ties += t ** 3 - t
+        i = j + 1
+    u = sum(r for r, (_, g) in zip(ranks, values) if g) - n2 * (n2 + 1) / 2.0
+    sigma = math.sqrt(n1 * n2 / 12.0 * ((n + 1) - ties / (n * (n - 1))))
+    if sigma == 0:
+        return 1.0
+    z = (u - n1 * n2 / 2.0 - 0.5) / sigma
+    return 0.5 * math.erfc(z / math.sqrt(2))
+
+
+def parse_shard(spec):
+    m = re.match(r'^\s*(\d+)\s*/\s*(\d+)\s*$', spec)
+    if not m or not 1 <= int(m.group(1)) <= int(m.group(2)):
+        raise Exception('invalid shard, expect i/n with 1 <= i <= n: ' + spec)
+    return int(m.group(1)), int(m.group(2))
+
+
+def in_shard(i, index, total):
+    return int(hashlib.sha1(i).hexdigest()[:8], 16) % total == index - 1
+
+
+def shard_cases(ids, index, total, timings=None):
+    """ Return the ids that belong to shard `index` of `total`. Cases are
+        spread by hash, or bin-packed longest first when `timings` knows
+        some of them; both only depend on the set of ids.
+    """
+    ids = sorted(set(ids))
+    known = [timings[i] for i in ids if timings and i in timings]
+    if not known:
+        return set(i for i in ids if in_shard(i, index, total))
+
+    default = sum(known) / len(known)
+    durations = dict((i, timings.get(i, default)) for i in ids)
+    loads = [(0.0, n) for n in range(total)]
+    mine = set()
+    for i in sorted(ids, key=lambda i: (-durations[i], i)):
+        load, n = min(loads)
+        loads[n] = (load + durations[i], n)
+        if n == index - 1:
+            mine.add(i)
+    return mine
+
+
+class MatrixCases(object):
+    """ The cases of a template selected by run_only and a shard, they
+        are generated on demand with normalized names and precompiled
+        assertions. Matrix cases are sharded by hash, without timings.
+    """
+    def __init__(self, zt, template, run_only=None, shard=None):
+        self.zt = zt
+        self.template = template
+        self.run_only = run_only
+        self.shard = shard
+        self.lineno = template.lineno
+
+    def sharded(self, index, total):
+        return MatrixCases(self.zt, self.template, self.run_only,
+                           (index, total))
+
+    def select(self, name):
+        if self.run_only and not re.search(self.run_only, name):
+            return False
+        return self.shard is None or in_shard(
+            '%s:%s' % (self.zt, normalize_name(name)), *self.shard)
+
+    def names(self):
+        for name in self.template.names():
+            if self.select(name):
+                yield normalize_name(name)
+
+    def __iter__(self):
+        for case in self.template.expand(self.select):
+            case.name = normalize_name(case.name)
+            precompile(self.zt, case)
+            yield case
+
+
+class MatrixSuite(unittest.TestSuite):
+    """ Tests of matrix cases, generated while the suite runs a batch
+        size at a time. The tests that ran stay in the suite for the
+        recorders.
+    """
+    def __init__(self, zt, cases, env, cache=None, g=None, batch=False):
+        super(MatrixSuite, self).__init__()
+        self.zt = zt
+        self.cases = cases
+        self.env = env
+        self.cache = cache
+        self.g = g
+        self.batch = batch
+
+    def chunks(self):
+        chunk = []
+        for case in self.cases:
+            chunk.append(case)
+            if len(chunk) >= nginx_batch_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def run(self, result):
+        for chunk in self.chunks():
+            if result.shouldStop:
+                break
+            suite = unittest.TestSuite()
+            add_test_case(self.zt, suite, chunk, self.env, self.cache,
+                          self.g, self.batch)
+            self.addTest(suite)
+            suite(result)
+        return result
+
+
+def add_test_case(zt, suite, cases, env, cache=None, g=None, batch=False):
+    """ Add the cases of `zt` to `suite`, return the number of cases
+        that will actually run, counting matrix cases as one. With
+        `batch`, consecutive cases that can share an nginx load are
+        grouped into a `Batch`.
+    """
+    count, current, tests = 0, None, None
     for case in cases:
-        if case.name is None:
-            case.name = ''
-        if run_only and not re.search(run_only, case.name):
+        if isinstance(case, MatrixCases):
+            suite.addTest(MatrixSuite(zt, case, env, cache, g, batch))
+            count, current, tests = count + 1, None, None
             continue
-        case.name = re.sub(r'[^.\w]+', '_', case.name)
-        suite.addTest(
-            ContextTestCase.addContext(
-                type('%s<%s:%s>' % (case.name, zt, case.lineno),
-                     (TestNginx,), {}), ctx=Ctx(case, env)))
+        ctx = Ctx(case, env, zt)
+        if cache is not None:
+            ctx.fingerprint = cache.fingerprint(zt, case, g)
+            ctx.cached = cache.hit(ctx.fingerprint)
+        if not ctx.cached:
+            count += 1
+            if batch and Batch.batchable(case):
+                if current is None or len(current) >= nginx_batch_size:
+                    current = Batch(TestNginx.nginx_prefix if os.environ.get(
+                        'ZTEST_UNIX') == '1' else None)
+                ctx.batch = current.add(case)
+            else:
+                current = None
+        if tests is None:
+            tests = ContextSuite(TestNginx, 'test_run')
+            suite.addTest(tests)
+        tests.addContext(ctx)
+    return count
+
+
+def iter_tests(suite):
+    for test in suite:
+        if isinstance(test, unittest.TestSuite):
+            for t in iter_tests(test):
+                yield t
+        else:
+            yield test
+
+
+def file_digest(f):
+    h = hashlib.sha1()
+    try:
+        with open(f, 'rb') as fd:
+            for chunk in iter(lambda: fd.read(stream_chunk_size), b''):
+                h.update(chunk)
+    except IOError:
+        return None
+    return h.hexdigest()
 
 
 def get_headers(text):
@@ -141,6 +764,1042 @@ def get_headers(text):
     return headers
 
 
+class ProcStat(object):
+    """ Resource usage of one process read from /proc, fields are None
+        when they cannot be read.
+    """
+    clock_ticks = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') \
+        else 100
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.ppid = None
+        self.cpu_ms = None
+        self.rss_kb = None
+        self.fds = None
+        self.ctxt_switches = None
+
+    @staticmethod
+    def read(pid, fds=True):
+        p = ProcStat(pid)
+        try:
+            with open('/proc/%d/stat' % pid) as fd:
+                fields = fd.read().rsplit(')', 1)[1].split()
+            p.ppid = int(fields[1])
+            p.cpu_ms = (int(fields[11]) + int(fields[12])) * 1000 // \
+                ProcStat.clock_ticks
+            with open('/proc/%d/status' % pid) as fd:
+                status = dict(line.split(':', 1) for line in fd
+                              if ':' in line)
+        except (IOError, OSError, IndexError, ValueError):
+            return None
+        if 'VmRSS' in status:
+            p.rss_kb = int(status['VmRSS'].split()[0])
+        if 'voluntary_ctxt_switches' in status:
+            p.ctxt_switches = int(status['voluntary_ctxt_switches']) + \
+                int(status.get('nonvoluntary_ctxt_switches', 0))
+        if fds:
+            try:
+                p.fds = len(os.listdir('/proc/%d/fd' % pid))
+            except OSError:
+                pass
+        return p
+
+    def as_dict(self):
+        return {'pid': self.pid, 'cpu_ms': self.cpu_ms, 'rss_kb': self.rss_kb,
+                'fds': self.fds, 'ctxt_switches': self.ctxt_switches}
+
+
+class NginxUsage(object):
+    """ A snapshot of the nginx master and its worker processes.
+    """
+    def __init__(self, master, workers):
+        self.master = master
+        self.workers = workers
+
+    @staticmethod
+    def sample(pid_file):
+        try:
+            pid = int(open(pid_file).read().strip())
+        except (IOError, ValueError):
+            return None
+        master = ProcStat.read(pid)
+        if master is None:
+            return None
+        workers = []
+        for entry in os.listdir('/proc'):
+            if entry.isdigit() and int(entry) != pid:
+                p = ProcStat.read(int(entry), fds=False)
+                if p is not None and p.ppid == pid:
+                    workers.append(ProcStat.read(p.pid) or p)
+        return NginxUsage(master, workers)
+
+    def processes(self):
+        return [self.master] + self.workers
+
+    def max_worker_rss_kb(self):
+        return max([w.rss_kb for w in self.workers if w.rss_kb] or [0])
+
+    def cpu_ms(self, before=None):
+        """ CPU time of master and workers, since `before` if given,
+            processes started since then count in full.
+        """
+        start = {}
+        if before is not None:
+            start = dict((p.pid, p.cpu_ms) for p in before.processes())
+        return sum(p.cpu_ms - start.get(p.pid, 0) for p in self.processes()
+                   if p.cpu_ms is not None)
+
+    def fd_growth(self, before):
+        """ Return (pid, before, after) for processes holding more fds
+            than in `before`.
+        """
+        start = dict((p.pid, p.fds) for p in before.processes())
+        return [(p.pid, start[p.pid], p.fds) for p in self.processes()
+                if start.get(p.pid) is not None and p.fds is not None and
+                p.fds > start[p.pid]]
+
+    def as_dict(self, before=None):
+        return {'master': self.master.as_dict(),
+                'workers': [w.as_dict() for w in self.workers],
+                'cpu_ms': self.cpu_ms(before),
+                'max_worker_rss_kb': self.max_worker_rss_kb()}
+
+
+class ShellJob(object):
+    """ A shell command running in the background, its output is read by
+        a thread so the pipes never fill up, and it is killed with its
+        process group once `timeout` seconds have passed.
+    """
+    def __init__(self, command, timeout=None):
+        from subprocess import Popen, PIPE
+
+        self.command = command
+        self.timeout = timeout
+        self.stdout = None
+        self.stderr = None
+        self.returncode = None
+        self.timed_out = False
+        self.process = Popen(args=command, stdout=PIPE, stderr=PIPE,
+                             shell=True, close_fds=True, preexec_fn=os.setsid)
+
+        self.thread = threading.Thread(target=self._communicate)
+        self.thread.daemon = True
+        self.thread.start()
+
+        self.timer = None
+        if timeout:
+            self.timer = threading.Timer(timeout, self.kill)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def _communicate(self):
+        self.stdout, self.stderr = self.process.communicate()
+        self.returncode = self.process.returncode
+
+    def kill(self):
+        if self.process.poll() is None:
+            self.timed_out = True
+            try:
+                os.killpg(self.process.pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+    def wait(self):
+        self.thread.join()
+        if self.timer is not None:
+            self.timer.cancel()
+        return self
+
+    def check(self):
+        """ Wait for the command, fail if it timed out or did not exit 0.
+        """
+        self.wait()
+        assert not self.timed_out, 'shell command timed out after %ss: %s' % (
+            self.timeout, self.command)
+        assert self.returncode == 0, 'shell command exited %d: %s\n%s' % (
+            self.returncode, self.command, self.stderr)
+        return self
+
+
+class StreamDigest(object):
+    """ Hash and count a streamed response body.
+    """
+    def __init__(self):
+        self.sha256 = hashlib.sha256()
+        self.length = 0
+
+    def update(self, chunk):
+        self.sha256.update(chunk)
+        self.length += len(chunk)
+
+    def finish(self):
+        pass
+
+    def hexdigest(self):
+        return self.sha256.hexdigest()
+
+
+class StreamFile(object):
+    """ Compare a streamed response body against a file chunk by chunk.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.fd = open(path, 'rb')
+        self.offset = 0
+        self.error = None
+
+    def update(self, chunk):
+        if self.error is not None:
+            return
+        expected = self.fd.read(len(chunk))
+        if expected != chunk:
+            for idx, c in enumerate(expected):
+                if c != chunk[idx]:
+                    break
+            else:
+                idx = len(expected)
+            self.error = 'response body differs from %s at offset %d' % (
+                self.path, self.offset + idx)
+        self.offset += len(chunk)
+
+    def finish(self):
+        if self.error is None and self.fd.read(1):
+            self.error = 'response body shorter than %s: %d bytes' % (
+                self.path, self.offset)
+        self.fd.close()
+
+
+class StreamSearch(object):
+    """ Search a streamed response body chunk by chunk. Matches longer
+        than `stream_match_max` bytes, or the max_match=N option, may be
+        missed: only that many bytes minus one are carried over to the
+        next chunk, a start position before them was already tried with
+        every match length allowed. Patterns backtracking over long runs,
+        like a+x, still cost a chunk squared, bound them as in a{8}x.
+    """
+    def __init__(self, pattern, option):
+        self.regex = compile_pattern(pattern)
+        self.pattern = self.regex.pattern
+        self.unlike = 'unlike' in option
+        self.overlap = int(Lexer.get_option_value(
+            option, 'max_match', stream_match_max)) - 1
+        self.tail = ''
+        self.found = False
+        self.error = None
+
+    def update(self, chunk):
+        if self.found:
+            return
+        text = self.tail + chunk
+        if self.regex.search(text):
+            self.found = True
+            self.tail = ''
+        else:
+            self.tail = text[len(text) - self.overlap:] if self.overlap else ''
+
+    def finish(self):
+        self.tail = ''
+        if self.unlike and self.found:
+            self.error = 'response body matches: %s' % self.pattern
+        elif not self.unlike and not self.found:
+            self.error = 'response body does not match: %s' % self.pattern
+
+
+class StreamTiming(object):
+    """ Arrival times of the chunks of a streamed response body, in ms
+        since the request was sent. The chunks themselves are kept with
+        `keep`.
+    """
+    def __init__(self, start, headers_ms, keep=False):
+        self.start = start
+        self.headers_ms = headers_ms
+        self.ttfb_ms = None
+        self.times = []
+        self.data = [] if keep else None
+
+    def update(self, chunk):
+        if not chunk:
+            return
+        now = (time.time() - self.start) * 1000
+        if self.ttfb_ms is None:
+            self.ttfb_ms = now
+        self.times.append(now)
+        if self.data is not None:
+            self.data.append(chunk)
+
+    def finish(self):
+        # without a body the first bytes are the headers
+        if self.ttfb_ms is None:
+            self.ttfb_ms = self.headers_ms
+
+    def gaps(self):
+        return [b - a for a, b in zip(self.times, self.times[1:])]
+
+
+class Timings(dict):
+    """ Per-case durations in seconds recorded by previous runs.
+    """
+    def __init__(self, path):
+        super(Timings, self).__init__()
+        self.path = path
+
+        try:
+            with open(path) as fd:
+                self.update(json.load(fd))
+        except (IOError, ValueError):
+            pass
+
+    def record(self, suite, result):
+        skipped = set(id(t) for t, _ in result.skipped)
+        for test in iter_tests(suite):
+            ctx = getattr(test, 'ctx', None)
+            if ctx is None or id(test) in skipped or \
+                    test not in result.durations:
+                continue
+            self[case_id(ctx.zt, ctx.case)] = result.durations[test]
+
+    def save(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as fd:
+            json.dump(self, fd, indent=0, sort_keys=True)
+        os.rename(tmp, self.path)
+
+
+class TimingResult(unittest.TextTestResult):
+    """ Text result that also measures the duration of every test.
+    """
+    def __init__(self, *args, **kwargs):
+        super(TimingResult, self).__init__(*args, **kwargs)
+        self.durations = {}
+        self.started = None
+
+    def startTest(self, test):
+        self.started = time.time()
+        super(TimingResult, self).startTest(test)
+
+    def stopTest(self, test):
+        super(TimingResult, self).stopTest(test)
+        self.durations[test] = time.time() - self.started
+
+
+class HeaderDict(dict):
+    """ Response headers with case-insensitive lookup.
+    """
+    def __setitem__(self, k, v):
+        super(HeaderDict, self).__setitem__(k.lower(), v)
+
+    def __getitem__(self, k):
+        return super(HeaderDict, self).__getitem__(k.lower())
+
+    def __contains__(self, k):
+        return super(HeaderDict, self).__contains__(k.lower())
+
+    def get(self, k, default=None):
+        return super(HeaderDict, self).get(k.lower(), default)
+
+
+class RawResponse(object):
+    """ Response read by `RawConnection`, with the attributes of a
+        `requests` response the assertions use.
+    """
+    def __init__(self, version, status_code, reason, headers, content, raw):
+        self.version = version
+        self.status_code = status_code
+        self.reason = reason
+        self.headers = headers
+        self.content = content
+        self.raw = raw
+
+    def iter_content(self, chunk_size=1):
+        for pos in range(0, len(self.content), chunk_size):
+            yield self.content[pos:pos + chunk_size]
+
+
+class ConnectionClosed(IOError):
+    """ The peer closed the connection before sending a response byte.
+    """
+
+
+class SocketReader(object):
+    """ Buffered, incremental reads of HTTP/1.1 messages from a socket.
+        Unread bytes are `buf` from `pos` on, then the received `parts`,
+        joined only when a read needs them.
+    """
+    def __init__(self, sock):
+        self.sock = sock
+        self.buf = ''
+        self.pos = 0
+        self.parts = []
+        self.size = 0
+        self.closed = False
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.sock.close()
+
+    def _fill(self):
+        data = self.sock.recv(stream_chunk_size)
+        if not data:
+            self.closed = True
+            return False
+        self.parts.append(data)
+        self.size += len(data)
+        return True
+
+    def _join(self):
+        if self.parts:
+            self.buf = self.buf[self.pos:] + ''.join(self.parts)
+            self.pos, self.parts = 0, []
+
+    def _take(self, n):
+        data = self.buf[self.pos:self.pos + n]
+        self.pos += n
+        self.size -= n
+        if self.pos == len(self.buf):
+            self.buf, self.pos = '', 0
+        return data
+
+    def _read_line(self):
+        searched = 0
+        while True:
+            end = self.buf.find('\n', self.pos + searched)
+            if end != -1:
+                return self._take(end + 1 - self.pos)
+            searched = len(self.buf) - self.pos
+            if not self.parts and not self._fill():
+                raise IOError('connection closed in message head')
+            self._join()
+
+    def _read(self, n):
+        while self.size < n:
+            if not self._fill():
+                raise IOError('connection closed in message body')
+        if len(self.buf) - self.pos < n:
+            self._join()
+        return self._take(n)
+
+    def _read_all(self):
+        while self._fill():
+            pass
+        self._join()
+        return self._take(self.size)
+
+    def _read_chunked(self):
+        raw, body = [], []
+        while True:
+            line = self._read_line()
+            raw.append(line)
+            size = int(line.split(';', 1)[0].strip(), 16)
+            if size == 0:
+                break
+            chunk = self._read(size)
+            raw.append(chunk)
+            body.append(chunk)
+            raw.append(self._read_line())
+        while True:  # trailers
+            line = self._read_line()
+            raw.append(line)
+            if not line.strip():
+                break
+        return ''.join(body), ''.join(raw)
+
+    def _read_headers(self, head):
+        headers = HeaderDict()
+        while True:
+            line = self._read_line()
+            head.append(line)
+            if not line.strip():
+                return headers
+            k, v = line.split(':', 1)
+            if k in headers:
+                headers[k] += ', ' + v.strip()
+            else:
+                headers[k] = v.strip()
+
+    def read_request(self):
+        """ Read a request, return None if the peer closed the connection
+            before sending one.
+        """
+        if not self.size and not self._fill():
+            return None
+        head = [self._read_line()]
+        method, uri, version = (head[0].strip().split(' ', 2) + ['', ''])[:3]
+        headers = self._read_headers(head)
+        if 'chunked' in headers.get('transfer-encoding', '').lower():
+            body, _ = self._read_chunked()
+        else:
+            body = self._read(int(headers.get('content-length', 0)))
+        return MockRequest(method, uri, version, headers, body)
+
+
+class RawConnection(SocketReader):
+    """ A plain socket to nginx that writes requests byte for byte and
+        parses HTTP/1.1 responses incrementally.
+    """
+    def __init__(self, api, timeout=socket_timeout, tls=False):
+        sock = connect(api, timeout)
+        super(RawConnection, self).__init__(tls_wrap(sock) if tls else sock)
+        self.used = False
+
+    def send(self, data):
+        self.used = True
+        self.sock.sendall(data)
+
+    def read_response(self, method='GET'):
+        if not self.size and not self._fill():
+            raise ConnectionClosed('connection closed before a response')
+        while True:
+            head = [self._read_line()]
+            version, status, reason = (head[0].rstrip('\r\n').split(' ', 2)
+                                       + [''])[:3]
+            status = int(status)
+            headers = self._read_headers(head)
+            if status != 100:
+                break
+
+        head = ''.join(head)
+        keepalive = version == 'HTTP/1.1' and \
+            headers.get('connection', '').lower() != 'close'
+        if method == 'HEAD' or status in (204, 304) or 100 <= status < 200:
+            body, raw = '', ''
+        elif 'chunked' in headers.get('transfer-encoding', '').lower():
+            body, raw = self._read_chunked()
+        elif 'content-length' in headers:
+            body = raw = self._read(int(headers['content-length']))
+        else:
+            body = raw = self._read_all()
+            keepalive = False
+
+        if not keepalive:
+            self.close()
+        return RawResponse(version, status, reason, headers, body,
+                           head + raw)
+
+
+class MockRequest(object):
+    """ A request received by a `MockUpstream`.
+    """
+    def __init__(self, method, uri, version, headers, body):
+        self.method = method
+        self.uri = uri
+        self.version = version
+        self.headers = headers
+        self.body = body
+
+    def __repr__(self):
+        return '<MockRequest %s %s>' % (self.method, self.uri)
+
+
+def parse_response_text(text):
+    """ Turn the text of an HTTP response in a .zt file into a response
+        spec for `MockUpstream`.
+    """
+    head, _, body = text.replace('\r\n', '\n').partition('\n\n')
+    lines = head.split('\n')
+    _, status, reason = (lines[0].split(' ', 2) + ['', ''])[:3]
+    return {'status': int(status), 'reason': reason, 'body': body,
+            'headers': [line.split(':', 1) for line in lines[1:]
+                        if ':' in line]}
+
+
+class MockUpstream(object):
+    """ An HTTP, or with `tcp` a raw TCP, server run inside the runner on
+        a free port. Each request is answered by the next spec of
+        `responses`, the last one repeating, or by calling `responses`
+        with the request. Received requests are kept in `requests`.
+
+        An HTTP spec is a dict with any of status, reason, headers, body,
+        chunks (sent chunked), chunk_delay, delay (before responding),
+        reset (reset the connection instead), close and raw (exact bytes
+        to send). A TCP spec has send, delay, reset.
+    """
+    def __init__(self, name, responses, tcp=False):
+        self.name = name
+        self.responses = responses
+        self.tcp = tcp
+        self.requests = []
+        self.server = None
+        self.port = None
+        self.conns = []
+        self.lock = threading.Lock()
+
+    @property
+    def address(self):
+        return '127.0.0.1:%d' % self.port
+
+    def start(self):
+        import SocketServer
+
+        upstream = self
+
+        class Handler(SocketServer.BaseRequestHandler):
+            def handle(self):
+                upstream.handle(self.request)
+
+        class Server(SocketServer.ThreadingTCPServer):
+            allow_reuse_address = True
+            daemon_threads = True
+
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.port = self.server.server_address[1]
+        thread = threading.Thread(target=self.server.serve_forever,
+                                  kwargs={'poll_interval': 0.05})
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        if self.server is None:
+            return
+        self.server.shutdown()
+        self.server.server_close()
+        with self.lock:
+            for sock in self.conns:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+        self.server = None
+
+    def receive(self, request):
+        """ Keep `request` and return the spec answering it, the index of a
+            list spec is taken under the lock along with the append so
+            concurrent connections each get their own.
+        """
+        with self.lock:
+            idx = len(self.requests)
+            self.requests.append(request)
+        return self.next_response(request, idx)
+
+    def next_response(self, request, idx):
+        if callable(self.responses):
+            spec = self.responses(request)
+        elif isinstance(self.responses, list):
+            spec = self.responses[min(idx, len(self.responses) - 1)]
+        else:
+            spec = self.responses
+        if isinstance(spec, str):
+            spec = self.tcp and {'send': spec} or parse_response_text(spec)
+        return spec
+
+    def handle(self, sock):
+        with self.lock:
+            self.conns.append(sock)
+        try:
+            if self.tcp:
+                self.handle_tcp(sock)
+            else:
+                self.handle_http(sock)
+        except (IOError, socket.error):
+            pass
+        finally:
+            with self.lock:
+                self.conns.remove(sock)
+
+    @staticmethod
+    def reset(sock):
+        import struct
+
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                        struct.pack('ii', 1, 0))
+        sock.close()
+
+    def handle_tcp(self, sock):
+        data = sock.recv(stream_chunk_size)
+        spec = self.receive(data)
+        time.sleep(spec.get('delay', 0))
+        if spec.get('reset'):
+            return self.reset(sock)
+        sock.sendall(spec.get('send', ''))
+
+    def handle_http(self, sock):
+        reader = SocketReader(sock)
+        while True:
+            request = reader.read_request()
+            if request is None:
+                return
+            spec = self.receive(request)
+            time.sleep(spec.get('delay', 0))
+            if spec.get('reset'):
+                return self.reset(sock)
+            self.respond(sock, spec)
+            if spec.get('close') or \
+                    request.headers.get('connection', '').lower() == 'close':
+                return
+
+    def respond(self, sock, spec):
+        if 'raw' in spec:
+            return sock.sendall(spec['raw'])
+
+        headers = spec.get('headers', {})
+        if isinstance(headers, dict):
+            headers = headers.items()
+        chunks = spec.get('chunks')
+        head = ['HTTP/1.1 %d %s' % (spec.get('status', 200),
+                                    spec.get('reason', 'OK'))]
+        head.extend('%s: %s' % (k.strip(), v.strip()) for k, v in headers)
+        if chunks is not None:
+            head.append('Transfer-Encoding: chunked')
+        else:
+            head.append('Content-Length: %d' % len(spec.get('body', '')))
+        if spec.get('close'):
+            head.append('Connection: close')
+        sock.sendall('\r\n'.join(head) + '\r\n\r\n')
+
+        if chunks is None:
+            return sock.sendall(spec.get('body', ''))
+        for chunk in chunks:
+            time.sleep(spec.get('chunk_delay', 0))
+            sock.sendall('%x\r\n%s\r\n' % (len(chunk), chunk))
+        sock.sendall('0\r\n\r\n')
+
+
+class ResultCache(object):
+    """ Fingerprints of the cases that passed last time, a case whose
+        fingerprint is found here is skipped unless `force` is set.
+    """
+    def __init__(self, path, force=False):
+        self.path = path
+        self.force = force
+        self.passed = {}
+        self.seen = {}
+        self.files = set()
+        self.environ = None
+
+        try:
+            with open(path) as fd:
+                self.passed = json.load(fd)
+        except (IOError, ValueError):
+            self.passed = {}
+
+    def environment(self):
+        """ Fingerprint of everything outside the .zt files a case depends
+            on: the nginx template, the nginx binary, the runner itself and
+            the run modes in `cache_modes`.
+        """
+        if self.environ is None:
+            nginx_bin = TestNginx.nginx_bin
+            mtime = None
+            if os.path.isfile(nginx_bin):
+                mtime = os.path.getmtime(nginx_bin)
+            runner = os.path.splitext(os.path.abspath(__file__))[0] + '.py'
+            self.environ = [nginx_template, nginx_server_template,
+                            nginx_ssl_template, nginx_bin, mtime,
+                            file_digest(nginx_bin), file_digest(runner),
+                            [os.environ.get(k) for k in cache_modes]]
+        return self.environ
+
+    def fingerprint(self, zt, case, g):
+        fp = case_fingerprint(zt, case, g, self.environment())
+        self.seen[fp] = zt
+        self.files.add(zt)
+        return fp
+
+    def hit(self, fp):
+        return not self.force and fp in self.passed
+
+    def record(self, suite, result):
+        failed = set(id(t) for t, _ in result.failures + result.errors)
+        skipped = set(id(t) for t, _ in result.skipped)
+        for test in iter_tests(suite):
+            ctx = getattr(test, 'ctx', None)
+            if ctx is None or ctx.fingerprint is None:
+                continue
+            if id(test) in failed:
+                self.passed.pop(ctx.fingerprint, None)
+            elif id(test) not in skipped:
+                self.passed[ctx.fingerprint] = self.seen[ctx.fingerprint]
+
+    def save(self):
+        # forget cases that disappeared from the files collected this run
+        passed = dict((fp, zt) for fp, zt in self.passed.iteritems()
+                      if fp in self.seen or zt not in self.files)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as fd:
+            json.dump(passed, fd)
+        os.rename(tmp, self.path)
+
+
+class Batch(object):
+    """ Independent cases served by one nginx load, each in its own
+        server block on a distinct port, or a distinct Unix socket under
+        `prefix` when given. What nginx logs while loading the config is
+        in the error log of no case, as for a case run alone, so a batch
+        does not report the warnings of one of its configs.
+    """
+    breakers = ['reload_nginx', 'restart_nginx', 'upstream']
+
+    def __init__(self, prefix=None):
+        self.prefix = prefix
+        self.apis = {}
+        self.configs = []
+        self.loaded = False
+
+    def __len__(self):
+        return len(self.configs)
+
+    @staticmethod
+    def config_item(case):
+        for item in case.items:
+            if item.name == 'config':
+                return item
+            if item.name not in TestNginx.common_items:
+                break
+        return None
+
+    @staticmethod
+    def batchable(case):
+        """ A case can be batched when it has a static config, does not
+            opt out with `--- config alone`, and never reloads nginx.
+        """
+        item = Batch.config_item(case)
+        if item is None or 'eval' in item.option or 'alone' in item.option:
+            return False
+        return not any(i.name in Batch.breakers for i in case.items)
+
+    def add(self, case):
+        idx = len(self.configs)
+        if self.prefix is None:
+            api = '127.0.0.1:%d' % (nginx_batch_port + idx)
+        else:
+            api = unix_api(self.prefix, 'batch-%d' % idx)
+        self.apis[id(case)] = api
+        self.configs.append((api, Batch.config_item(case).value,
+                             case_ssl(case)))
+        return self
+
+    def api(self, case):
+        return self.apis[id(case)]
+
+    def render(self):
+        return render_conf(self.configs)
+
+
+class BenchStore(object):
+    """ Per-case performance results appended to a JSON lines store,
+        keyed by case fingerprint and git revision, and compared with the
+        results of a baseline revision.
+    """
+    def __init__(self, path, files, rev=None, tolerance=None):
+        self.path = path
+        self.rev = rev or git_revision()
+        self.run = '%d.%d' % (os.getpid(), time.time() * 1000000)
+        self.tolerance = dict(bench_tolerance)
+        self.tolerance.update(tolerance or {})
+        self.records = []
+        # fingerprint cases now, running them evaluates their items
+        self.fingerprints = dict(
+            (id(case), case_fingerprint(zt, case, g))
+            for zt, g, _, cases in files for case in cases
+            if not isinstance(case, MatrixCases))
+        self.globals = dict((zt, g) for zt, g, _, _ in files)
+
+    @staticmethod
+    def parse_tolerance(spec):
+        """ Parse `0.1` for every metric or `latency_ms=0.1,cpu_ms=0.3`.
+        """
+        if not spec:
+            return {}
+        if '=' not in spec:
+            return dict((k, float(spec)) for k in bench_tolerance)
+        return dict((k.strip(), float(v)) for k, v in
+                    (kv.split('=', 1) for kv in spec.split(',')))
+
+    def record(self, suite, result):
+        failed = set(id(t) for t, _ in
+                     result.failures + result.errors + result.skipped)
+        for test in iter_tests(suite):
+            ctx = getattr(test, 'ctx', None)
+            if ctx is None or id(test) in failed or \
+                    test not in result.durations:
+                continue
+            latency = [t * 1000 for name, _, t in getattr(test, 'phases', [])
+                       if name == 'request']
+            usage = getattr(test, 'usage', None) or {}
+            self.records.append({
+                'rev': self.rev,
+                'run': self.run,
+                'fingerprint': self.fingerprints.get(id(ctx.case)) or
+                case_fingerprint(ctx.zt, ctx.case, self.globals.get(ctx.zt)),
+                'case': case_id(ctx.zt, ctx.case),
+                'time': time.time(),
+                'latency_ms': latency,
+                'p50_ms': percentile(latency, 50),
+                'p90_ms': percentile(latency, 90),
+                'p99_ms': percentile(latency, 99),
+                'throughput': latency and
+                len(latency) * 1000.0 / sum(latency) or None,
+                'cpu_ms': usage.get('cpu_ms'),
+                'rss_kb': usage.get('max_worker_rss_kb'),
+            })
+
+    def save(self):
+        with open(self.path, 'a') as fd:
+            for record in self.records:
+                fd.write(json.dumps(record) + '\n')
+
+    def load(self, rev):
+        records = []
+        try:
+            with open(self.path) as fd:
+                for line in fd:
+                    record = json.loads(line)
+                    if record['rev'].startswith(rev) and \
+                            record.get('run') != self.run:
+                        records.append(record)
+        except (IOError, ValueError):
+            pass
+        return records
+
+    def _regressed(self, metric, base, current, higher_is_worse=True):
+        if base is None or current is None:
+            return False
+        delta = current - base
+        if not higher_is_worse:
+            delta = -delta
+        return delta > bench_min_delta[metric] and \
+            delta > abs(base) * self.tolerance[metric]
+
+    def compare(self, baseline):
+        """ Return the regressions of this run against the results of
+            revision `baseline`, latencies must also be significantly
+            slower by a Mann-Whitney U test.
+        """
+        base = {}
+        for record in self.load(baseline):
+            base.setdefault(record['case'], []).append(record)
+
+        regressions = []
+        for record in self.records:
+            records = base.get(record['case'])
+            if not records:
+                continue
+            name = record['case']
+            if all(r['fingerprint'] != record['fingerprint']
+                   for r in records):
+                name += ' (case changed)'
+
+            before = sum((r['latency_ms'] for r in records), [])
+            after = record['latency_ms']
+            if len(before) >= bench_min_samples and \
+                    len(after) >= bench_min_samples and \
+                    self._regressed('latency_ms', percentile(before, 50),
+                                    percentile(after, 50)):
+                p = mann_whitney_p(before, after)
+                if p < bench_alpha:
+                    regressions.append('%s: p50 latency %.2f ms -> %.2f ms '
+                                       '(p=%.4f)' % (
+                                           name, percentile(before, 50),
+                                           percentile(after, 50), p))
+
+            for metric, higher_is_worse in (('throughput', False),
+                                            ('cpu_ms', True),
+                                            ('rss_kb', True)):
+                values = [r[metric] for r in records
+                          if r.get(metric) is not None]
+                if not values:
+                    continue
+                mean = float(sum(values)) / len(values)
+                if self._regressed(metric, mean, record[metric],
+                                   higher_is_worse):
+                    regressions.append('%s: %s %.2f -> %.2f' % (
+                        name, metric, mean, record[metric]))
+        return regressions
+
+
+class Report(object):
+    """ Machine-readable results with per-phase timings, written as
+        JUnit XML and/or JSON lines.
+    """
+    def __init__(self, junit=None, jsonl=None):
+        self.junit = junit
+        self.jsonl = jsonl
+        self.records = []
+
+    @staticmethod
+    def outcomes(result):
+        outcomes = {}
+        for kind, tests in (('skipped', result.skipped),
+                            ('failure', result.failures),
+                            ('error', result.errors)):
+            for test, message in tests:
+                outcomes[id(test)] = (kind, message)
+        return outcomes
+
+    def record(self, suite, result):
+        outcomes, seen = Report.outcomes(result), set()
+        for test in iter_tests(suite):
+            ctx = getattr(test, 'ctx', None)
+            if ctx is None or test not in result.durations:
+                continue
+            seen.add(id(test))
+            outcome, message = outcomes.get(id(test), ('passed', None))
+            self.records.append({
+                'file': ctx.zt,
+                'line': ctx.case.lineno,
+                'name': ctx.case.name,
+                'outcome': outcome,
+                'message': message,
+                'time': result.durations[test],
+                'phases': [{'phase': name, 'label': label, 'time': t}
+                           for name, label, t in getattr(test, 'phases', [])],
+                'usage': getattr(test, 'usage', None),
+            })
+        # errors outside of cases, e.g. a failing global setup
+        for test, message in result.errors:
+            if id(test) not in seen:
+                self.records.append({
+                    'file': None, 'line': None, 'name': str(test),
+                    'outcome': 'error', 'message': message, 'time': 0.0,
+                    'phases': []})
+
+    def save(self):
+        if self.jsonl:
+            with open(self.jsonl, 'w') as fd:
+                for record in self.records:
+                    fd.write(json.dumps(record) + '\n')
+        if self.junit:
+            self.save_junit()
+
+    def save_junit(self):
+        import xml.etree.ElementTree as ET
+
+        root, suites = ET.Element('testsuites'), {}
+        for record in self.records:
+            zt = record['file'] or ''
+            if zt not in suites:
+                suites[zt] = ET.SubElement(root, 'testsuite', name=zt)
+            testcase = ET.SubElement(
+                suites[zt], 'testcase', classname=zt, name=record['name'],
+                file=zt, line=str(record['line'] or 0),
+                time='%.6f' % record['time'])
+            if record['phases']:
+                properties = ET.SubElement(testcase, 'properties')
+                for idx, p in enumerate(record['phases']):
+                    name = 'phase.%d.%s' % (idx, p['phase'])
+                    if p['label']:
+                        name += '.' + p['label']
+                    ET.SubElement(properties, 'property', name=name,
+                                  value='%.6f' % p['time'])
+            if record['outcome'] != 'passed':
+                message = record['message'].strip().split('\n')[-1]
+                ET.SubElement(testcase, record['outcome'],
+                              message=message).text = record['message']
+
+        for zt, element in suites.iteritems():
+            cases = element.findall('testcase')
+            element.set('tests', str(len(cases)))
+            for kind, attr in (('failure', 'failures'), ('error', 'errors'),
+                               ('skipped', 'skipped')):
+                element.set(attr, str(sum(1 for c in cases
+                                          if c.find(kind) is not None)))
+            element.set('time', '%.6f' % sum(float(c.get('time'))
+                                              for c in cases))
+        ET.ElementTree(root).write(self.junit, encoding='utf-8')
+
+
 class LoggingFormatter(logging.Formatter):
     def __init__(self, fmt, datefmt=None):
         logging.Formatter.__init__(self, fmt, datefmt)
@@ -166,17 +1825,24 @@ def get_console_logger(name):
     return logger
 
 
-logger = get_console_logger('ztest')
+logger = None
 
 
 def LOG_ERR(s):
+    global logger
+    if logger is None:
+        logger = get_console_logger('ztest')
     logger.log(logging.ERROR, s)
 
 
 class Ctx(object):
-    def __init__(self, case, env):
+    def __init__(self, case, env, zt=None):
         self.case = case
         self.env = env
+        self.zt = zt
+        self.fingerprint = None
+        self.cached = False
+        self.batch = None
 
 
 class Nginx(object):
@@ -207,6 +1873,12 @@ class Nginx(object):
     def start(self):
         if self.pid():
             return
+        # sockets left by a killed nginx would make its listen fail
+        sockets = unix_dir(self.prefix, create=False)
+        if os.path.isdir(sockets):
+            for name in os.listdir(sockets):
+                if name.endswith('.sock'):
+                    os.unlink(os.path.join(sockets, name))
         system('%s -p %s -c %s' % (self.nginx_bin,
                self.prefix, 'conf/nginx.conf'))
         while not self.pid():
@@ -235,78 +1907,178 @@ class Nginx(object):
 
 
 class TestNginx(ContextTestCase):
-    common_items = ['config', 'setup', 'teardown']
+    common_items = ['upstream', 'config', 'setup', 'teardown']
 
-    alone_items = ['setenv', 'shell', 'reload_nginx', 'restart_nginx']
-    union_items = ['request', 'more_headers', 'request_body']
+    alone_items = ['setenv', 'shell', 'shell_wait', 'reload_nginx',
+                   'restart_nginx']
+    union_items = ['request', 'more_headers', 'request_body',
+                   'request_body_file', 'raw_request', 'pipelined_requests']
+    request_items = ['request', 'raw_request', 'pipelined_requests']
     assert_items = ['assert', 'response_body', 'response_headers',
-                    'status_code', 'no_error_log', 'error_log']
+                    'status_code', 'no_error_log', 'error_log',
+                    'response_body_sha256', 'response_body_length',
+                    'response_body_file', 'max_worker_rss_kb', 'max_cpu_ms',
+                    'no_fd_leak', 'max_ttfb_ms', 'chunks']
+    stream_items = ['response_body_sha256', 'response_body_length',
+                    'response_body_file', 'max_ttfb_ms', 'chunks']
+    timing_items = ['max_ttfb_ms', 'chunks']
+    # a list value is the operand itself, not one per request
+    list_valued_items = ['chunks']
+    usage_items = ['max_worker_rss_kb', 'max_cpu_ms', 'no_fd_leak']
     exec_items = ['assert']
 
     nginx = None
+    api = nginx_api
     nginx_bin = os.path.join(openresty_root, 'sbin/nginx')
     nginx_prefix = os.path.join(os.path.expandvars('$PWD'),
                                 test_directory, 'servroot')
-    class_name = 'TestNginx'
+
+    def label(self):
+        """ `module.name<file:line>`, the name of the case in reports. """
+        if self.ctx is None or not self.ctx.case:
+            return unittest.util.strclass(self.__class__)
+        return '%s.%s<%s:%s>' % (self.__class__.__module__,
+                                 self.ctx.case.name, self.ctx.zt,
+                                 self.ctx.case.lineno)
+
+    def id(self):
+        return '%s.%s' % (self.label(), self._testMethodName)
+
+    def __str__(self):
+        return '%s (%s)' % (self._testMethodName, self.label())
+
+    def __repr__(self):
+        return '<%s testMethod=%s>' % (self.label(), self._testMethodName)
 
     def setUp(self):
         self.setup_ = None
         self.teardown_ = None
         self.skip = False
-
-        if self.__class__.__name__ == self.class_name:
+        self.phases = []
+        self.raw_conn = None
+        self.jobs = []
+        self.bodies = []
+        self.session = None
+        self.usage = None
+
+        if self.ctx is None:
             self.skip = True
             return
 
         self.error_log = ''
-        self.locals = {'self': self}
+        self.locals = {'self': self, 'shells': [], 'upstreams': {}}
         self.globals = None
 
-        if self.ctx is None or not self.ctx.case:
+        if not self.ctx.case:
             raise Exception('no test case found')
+        if self.ctx.cached:
+            self.skipTest('unchanged since last pass')
 
         self.name = self.ctx.case.name
-        self.items = self.ctx.case.items
+        # items are evaluated in place, keep the parsed case intact
+        self.items = [copy.copy(i) for i in self.ctx.case.items]
         if isinstance(self.ctx.env, dict):
             self.globals = self.ctx.env
 
         self.nginx = Nginx(self.nginx_prefix, self.nginx_bin)
+        if os.environ.get('ZTEST_UNIX') == '1':
+            self.api = unix_api(self.nginx_prefix)
+        self.ssl = case_ssl(self.ctx.case)
+        if self.ssl and self.api.startswith('unix:'):
+            raise Exception('ssl is not supported with ZTEST_UNIX')
         self.prepare()
 
         if self.setup_:
-            self.setup_()
+            with self.phase('setup'):
+                self.setup_()
 
         self.start_nginx()
+        self.locals['usage_before'] = None
+        if os.environ.get('ZTEST_USAGE') == '1' or \
+                os.environ.get('ZTEST_BENCH') == '1' or \
+                any(i.name in self.usage_items for i in self.items):
+            self.locals['usage_before'] = self.sample_usage()
 
     def tearDown(self):
+        for upstream in self.locals.get('upstreams', {}).values():
+            upstream.stop()
+        for job in self.jobs:
+            job.kill()
+        for body in self.bodies:
+            body.close()
+        if self.raw_conn is not None:
+            self.raw_conn.close()
+        if self.session is not None:
+            self.session.close()
         if self.teardown_:
-            self.teardown_()
+            with self.phase('teardown'):
+                self.teardown_()
+
+    @contextlib.contextmanager
+    def phase(self, name, label=None):
+        """ Record the time spent in a phase of the case for reports.
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.phases.append((name, label, time.time() - start))
+
+    def sample_usage(self):
+        """ Sample nginx from /proc, the latest sample is kept as `usage`
+            in the test locals.
+        """
+        usage = NginxUsage.sample(self.nginx.pid_file)
+        self.locals['usage'] = usage
+        return usage
 
     def start_nginx(self, *args):
-        self.nginx.start()
+        with self.phase('nginx', 'start'):
+            self.nginx.start()
 
     def stop_nginx(self, *args):
-        self.nginx.stop()
+        with self.phase('nginx', 'stop'):
+            self.nginx.stop()
 
     def reload_nginx(self, *args):
-        self.nginx.reload(True)
+        close_tls_client()
+        with self.phase('nginx', 'reload'):
+            self.nginx.reload(True)
 
     def restart_nginx(self, *args):
-        self.nginx.restart()
+        close_tls_client()
+        with self.phase('nginx', 'restart'):
+            self.nginx.restart()
 
     def config(self, data):
+        batch = self.ctx.batch
+        if batch is not None:
+            # the first case of a batch loads the config of all of them
+            self.api = batch.api(self.ctx.case)
+            if not batch.loaded:
+                self.load_config(batch.render())
+                batch.loaded = True
+            return
+
+        self.load_config(render_conf(
+            [(self.api, self.render_upstreams(data), self.ssl)]))
+
+    def load_config(self, text):
         servroot = self.nginx.prefix
         logspath = os.path.join(servroot, 'logs')
         confpath = os.path.join(servroot, 'conf')
 
-        system('mkdir -p %s' % logspath)
-        system('cp -r %s/conf %s' % (openresty_root, servroot))
+        with self.phase('config'):
+            system('mkdir -p %s' % logspath)
+            system('cp -r %s/conf %s' % (openresty_root, servroot))
 
-        conf = os.path.join(confpath, 'nginx.conf')
-        open(conf, 'w+').write(nginx_template % {'config': data})
+            conf = os.path.join(confpath, 'nginx.conf')
+            open(conf, 'w+').write(text)
 
-        self.nginx.reload()
-        time.sleep(.2)
+        close_tls_client()
+        with self.phase('nginx', 'reload'):
+            self.nginx.reload()
+            time.sleep(.2)
 
     def setup(self, code):
         self.setup_ = lambda: self._exec(code)
@@ -317,45 +2089,120 @@ class TestNginx(ContextTestCase):
     def setenv(self, item):
         self._exec(item.value)
 
+    def shell(self, item):
+        """ Run the command, or the eval'd list of commands in parallel,
+            of a shell item. With `background` the case goes on and the
+            commands are joined before the next non-shell item. Results
+            are appended to `shells` in the test locals.
+        """
+        commands = item.value
+        if not isinstance(commands, list):
+            commands = [commands]
+        timeout = float(Lexer.get_option_value(item.option, 'timeout',
+                                               shell_timeout))
+        jobs = [ShellJob(c, timeout) for c in commands]
+        self.locals['shells'].extend(jobs)
+        self.jobs.extend(jobs)
+        if 'background' not in item.option:
+            self.shell_wait()
+
+    def shell_wait(self, *args):
+        jobs, self.jobs = self.jobs, []
+        if not jobs:
+            return
+        with self.phase('shell', 'wait'):
+            for job in jobs:
+                job.wait()
+        for job in jobs:
+            job.check()
+
     def prepare(self):
         for idx, item in enumerate(self.items):
-            if item.name in self.common_items:
-                self.eval_item(item)
-                getattr(self, item.name)(item.value)
-            else:
+            if item.name not in self.common_items:
                 break
-        self.items = self.items[idx:]
+        else:
+            idx = len(self.items)
+        head, self.items = self.items[:idx], self.items[idx:]
 
-    def _blocks(self):
-        block = {}
-        for item in self.items:
+        # upstreams first, the config refers to their addresses
+        for item in sorted(head, key=lambda i: i.name != 'upstream'):
             self.eval_item(item)
+            if item.name == 'upstream':
+                self.upstream(item)
+            else:
+                getattr(self, item.name)(item.value)
+
+    def upstream(self, item):
+        name = Lexer.get_option_value(item.option, 'name', 'upstream')
+        self.locals['upstreams'][name] = MockUpstream(
+            name, item.value, tcp='tcp' in item.option).start()
+
+    def render_upstreams(self, data):
+        """ Replace {{name}} and {{name_port}} in a config with the address
+            and port of the upstream `name`.
+        """
+        for name, upstream in self.locals['upstreams'].iteritems():
+            data = data.replace('{{%s}}' % name, upstream.address)
+            data = data.replace('{{%s_port}}' % name, str(upstream.port))
+        return data
+
+    def _blocks(self):
+        block, evaluated = {}, set()
+        for idx, item in enumerate(self.items):
+            if idx not in evaluated:
+                self.eval_item(item)
             if item.name in self.union_items:
-                if item.name in block:
+                if item.name in block or (
+                        item.name in self.request_items and
+                        any(k in block for k in self.request_items)):
                     yield block
                     block = {}
                 block[item.name] = item
             else:
                 if block:
+                    block['stream'] = self._stream_items(idx, evaluated)
                     yield block
                     block = {}
                 yield item
 
+    def is_stream_item(self, item):
+        return item.name in self.stream_items or \
+            (item.name == 'response_body' and 'stream' in item.option)
+
+    def _stream_items(self, start, evaluated):
+        """ Collect the streaming assertions on the response of the block
+            ending at `start`, they must be known before the body is read.
+        """
+        items = []
+        for idx in range(start, len(self.items)):
+            item = self.items[idx]
+            if item.name in self.union_items or \
+                    item.name in self.alone_items:
+                break
+            if not self.is_stream_item(item):
+                continue
+            if idx not in evaluated:
+                self.eval_item(item)
+                evaluated.add(idx)
+            items.append(item)
+        return items
+
     def eval_item(self, item):
         if 'eval' in item.option:
             item.value = self._eval(item.value)
 
     def _exec(self, code):
-        exec(code, self.globals, self.locals)
+        exec(compile_code(code), self.globals, self.locals)
 
     def _eval(self, code):
-        return eval(code, self.globals, self.locals)
+        return eval(compile_code(code, 'eval'), self.globals, self.locals)
 
     @get_nginx_log
-    def do_request(self, block):
+    def do_request(self, block, index=None):
         request = block['request']
         if 'exec' in request.option:
-            return self._exec(request.value)
+            with self.phase('request', 'exec'):
+                return self._exec(request.value)
 
         m = request_match(request.value)
         assert m, 'invalid request block: ' + request.value
@@ -367,103 +2214,476 @@ class TestNginx(ContextTestCase):
             else:
                 headers += '\n' + block['more_headers'].value
         if 'request_body' in block:
+            extra = block['request_body'].value
             if body is None:
-                body = block['request_body'].value
+                body = extra
+            elif isinstance(extra, basestring):
+                body += extra
             else:
-                body += block['request_body'].value
+                # an evaluated generator, sent chunked after the text
+                body = itertools.chain([body], extra)
+        if 'request_body_file' in block:
+            assert body is None, 'request_body_file with another body'
+            body = self.open_body_file(block['request_body_file'])
 
         allow_redirects = False
         if 'allow_redirects' in block:
             allow_redirects = True
 
+        stream = block.get('stream')
         headers = get_headers(headers)
         method, uri = m.group('method'), m.group('uri')
+        # over a Unix socket the URL keeps the TCP api as its host, over
+        # TLS the name of the certificate so that SNI is sent
+        host = nginx_api if self.api.startswith('unix:') else self.api
+        scheme = 'https' if self.ssl else 'http'
+        if self.ssl:
+            host = 'localhost:%s' % host.rsplit(':', 1)[1]
         if uri.startswith('/'):
-            uri = 'http://%s%s' % (nginx_api, uri)
-        elif not re.match(r'https?://'):
-            uri = 'http://%s/%s' % (nginx_api, uri)
-        return getattr(requests, method.lower())(
-                       uri, headers=headers, data=body,
-                       allow_redirects=allow_redirects)
+            uri = '%s://%s%s' % (scheme, host, uri)
+        elif not re.match(r'https?://', uri):
+            uri = '%s://%s/%s' % (scheme, host, uri)
+        import requests
+
+        client = requests
+        if self.ssl:
+            client = tls_client()
+        elif self.api.startswith('unix:'):
+            if self.session is None:
+                self.session = unix_session(self.api)
+            client = self.session
+            # the adapter passes only the path, httplib would send the
+            # host of its pool
+            if not any(k.lower() == 'host' for k in headers):
+                headers['Host'] = re.match(r'https?://([^/?#]+)',
+                                           uri).group(1)
+
+        with self.phase('request', '%s %s' % (method, uri)):
+            start = time.time()
+            r = getattr(client, method.lower())(
+                        uri, headers=headers, data=body,
+                        allow_redirects=allow_redirects, stream=bool(stream))
+            if stream:
+                self.consume_stream(r, stream, index, start)
+        return r
+
+    def open_body_file(self, item):
+        """ Open a request body to stream from disk, mapped in memory with
+            the mmap option. It is closed at the end of the case.
+        """
+        fd = open(item.value, 'rb')
+        self.bodies.append(fd)
+        if 'mmap' not in item.option or not os.fstat(fd.fileno()).st_size:
+            return fd
+        import mmap
+        body = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        self.bodies.append(body)
+        return body
 
     def do_requests(self, block):
         r = []
-        for req in block['request'].value:
+        for idx, req in enumerate(block['request'].value):
             if not isinstance(req, str):
                 raise Exception('unexpected request type: ' + type(req))
             _block = copy.deepcopy(block)
             _block['request'].value = req
-            r.append(self.do_request(_block))
+            r.append(self.do_request(_block, idx))
         return r
 
+    def raw_connection(self):
+        """ Return the pooled raw connection of the case, a new one if the
+            last response closed it.
+        """
+        if self.raw_conn is None or self.raw_conn.closed:
+            self.raw_conn = RawConnection(self.api, tls=self.ssl)
+        return self.raw_conn
+
+    @staticmethod
+    def raw_method(data):
+        return data.lstrip().split(' ', 1)[0].upper()
+
+    def raw_exchange(self, data, methods):
+        """ Write `data` at once and read one response per method. A
+            reused connection nginx closed meanwhile, seen as a failed
+            send or as EOF before the first response byte, is replaced
+            once. Any other error is raised, nothing is sent twice.
+        """
+        conn = self.raw_connection()
+        if conn.used:
+            try:
+                conn.send(data)
+            except socket.error:
+                conn.close()
+            else:
+                try:
+                    first = conn.read_response(methods[0])
+                except ConnectionClosed:
+                    conn.close()
+                except:
+                    conn.close()
+                    raise
+                else:
+                    return [first] + self.read_responses(conn, methods[1:])
+            conn = self.raw_connection()
+        conn.send(data)
+        return self.read_responses(conn, methods)
+
+    @staticmethod
+    def read_responses(conn, methods):
+        try:
+            return [conn.read_response(m) for m in methods]
+        except:
+            conn.close()
+            raise
+
+    @get_nginx_log
+    def do_raw_request(self, block, index=None):
+        data = block['raw_request'].value
+        if not isinstance(data, str):
+            raise Exception('unexpected raw request type: ' + str(type(data)))
+        with self.phase('request', 'raw'):
+            r = self.raw_exchange(data, [self.raw_method(data)])[0]
+            if block.get('stream'):
+                self.consume_stream(r, block['stream'], index)
+        return r
+
+    def do_raw_requests(self, block):
+        r = []
+        for idx, data in enumerate(block['raw_request'].value):
+            _block = copy.deepcopy(block)
+            _block['raw_request'].value = data
+            r.append(self.do_raw_request(_block, idx))
+        return r
+
+    @get_nginx_log
+    def do_pipelined_requests(self, block):
+        pipeline = block['pipelined_requests'].value
+        if not isinstance(pipeline, list):
+            raise Exception('pipelined_requests expects a list, use eval')
+        with self.phase('request', 'pipelined'):
+            r = self.raw_exchange(''.join(pipeline),
+                                  [self.raw_method(d) for d in pipeline])
+            for idx, _r in enumerate(r):
+                if block.get('stream'):
+                    self.consume_stream(_r, block['stream'], idx)
+        return r
+
+    def consume_stream(self, r, items, index=None, start=None):
+        """ Read the response body once through `iter_content`, feeding
+            every streaming assertion, so memory stays constant. Given the
+            time the request was sent, chunk arrival times are recorded
+            for the timing assertions, a chunked body is then read one
+            HTTP chunk at a time.
+        """
+        digest, checks, timing = StreamDigest(), {}, None
+        chunk_size = stream_chunk_size
+        # with only timing assertions the body is kept for the others
+        buffered = all(i.name in self.timing_items for i in items)
+        if start is not None and \
+                any(i.name in self.timing_items for i in items):
+            keep = buffered or any(i.name == 'chunks' for i in items)
+            timing = StreamTiming(start, (time.time() - start) * 1000, keep)
+            if 'chunked' in r.headers.get('transfer-encoding', '').lower():
+                chunk_size = None
+
+        for item in items:
+            value = item.value
+            if index is not None and isinstance(value, list):
+                value = value[index]
+            if item.name == 'response_body_file':
+                checks[item.lineno] = StreamFile(value.strip())
+            elif item.name == 'response_body':
+                checks[item.lineno] = StreamSearch(value, item.option)
+
+        streams = [digest] + checks.values()
+        if timing is not None:
+            streams.append(timing)
+        for chunk in r.iter_content(chunk_size=chunk_size):
+            for s in streams:
+                s.update(chunk)
+        for s in streams:
+            s.finish()
+
+        r.stream_timing = timing
+        if buffered:
+            if timing is not None:
+                # iter_content consumed the body, hand it back to r.content
+                r._content = ''.join(timing.data)
+            return
+        r.stream_digest, r.stream_checks = digest, checks
+
+    def stream_check(self, r, item):
+        checks = getattr(r, 'stream_checks', None)
+        assert checks is not None and item.lineno in checks, \
+            'response body was not streamed'
+        error = checks[item.lineno].error
+        assert error is None, error
+
+    @classmethod
+    def parse_expected(cls, item):
+        """ Return the operand of an assertion item: an int, a header map
+            or a pattern compiled for like and unlike.
+        """
+        name, value = item.name, item.value
+        regex = 'like' in item.option or 'unlike' in item.option
+        if name == 'no_fd_leak':
+            return int(value or 0)
+        if name == 'chunks':
+            if isinstance(value, basestring):
+                value = value.strip()
+                return int(value) if value else None
+            return value
+        if name == 'max_ttfb_ms':
+            return float(value)
+        if name in ('status_code', 'response_body_length') or \
+                name in cls.usage_items:
+            return int(value)
+        if name == 'response_body_sha256':
+            return value.strip().lower()
+        if name == 'response_headers':
+            return dict((k, compile_pattern(v) if regex else v)
+                        for k, v in get_headers(value).iteritems())
+        if name == 'error_log':
+            if isinstance(value, list):
+                return [compile_pattern(p) for p in value]
+            return compile_pattern(value)
+        if name == 'no_error_log':
+            error_level = ['warn', 'error', 'crit', 'alert', 'emerg']
+            if value is None:
+                level = error_level[1:]
+            elif value in error_level:
+                level = error_level[error_level.index(value):]
+            else:
+                level = [value]
+            return compile_pattern(r'.+?\[(%s)\]' % '|'.join(level))
+        if regex and isinstance(value, basestring):
+            return compile_pattern(value)
+        return value
+
+    def expected(self, item):
+        pre = getattr(item, 'expected', None)
+        if pre is not None:
+            return pre.value
+        return self.parse_expected(item)
+
     def more_assert(self, pattern, text, option):
         if 'like' in option:
-            assert re.search(pattern, text), text
+            assert compile_pattern(pattern).search(text), text
         elif 'unlike' in option:
-            assert not re.search(pattern, text), text
+            assert not compile_pattern(pattern).search(text), text
         else:
             self.assertEqual(pattern, text)
 
     def assert_response_body(self, r, item):
-        self.more_assert(item.value, r.content, item.option)
+        if 'stream' in item.option:
+            return self.stream_check(r, item)
+        assert getattr(r, 'stream_digest', None) is None, \
+            'response body was streamed, use a streaming assertion'
+        self.more_assert(self.expected(item), r.content, item.option)
+
+    def assert_response_body_sha256(self, r, item):
+        digest = getattr(r, 'stream_digest', None)
+        assert digest is not None, 'response body was not streamed'
+        self.more_assert(self.expected(item), digest.hexdigest(),
+                         item.option)
+
+    def assert_response_body_length(self, r, item):
+        digest = getattr(r, 'stream_digest', None)
+        assert digest is not None, 'response body was not streamed'
+        self.more_assert(self.expected(item), digest.length, item.option)
+
+    def assert_response_body_file(self, r, item):
+        self.stream_check(r, item)
+
+    def stream_timing(self, r):
+        timing = getattr(r, 'stream_timing', None)
+        assert timing is not None, 'response was not timed, use --- request'
+        return timing
+
+    def assert_max_ttfb_ms(self, r, item):
+        ttfb, limit = self.stream_timing(r).ttfb_ms, self.expected(item)
+        assert ttfb <= limit, 'ttfb %.1f ms > %s ms' % (ttfb, limit)
+
+    def assert_chunks(self, r, item):
+        """ Compare the chunks of the body as they arrived with a list, or
+            their number with an int. The min_gap_ms and max_gap_ms options
+            bound the time between two chunks, a body held back and sent
+            at once fails min_gap_ms.
+        """
+        timing = self.stream_timing(r)
+        expected = self.expected(item)
+        if isinstance(expected, list):
+            self.assertEqual(expected, timing.data)
+        elif expected is not None:
+            assert len(timing.times) == expected, '%d chunks, expected %d' % (
+                len(timing.times), expected)
+
+        gaps = ', '.join('%.1f' % g for g in timing.gaps())
+        min_gap = Lexer.get_option_value(item.option, 'min_gap_ms')
+        if min_gap is not None:
+            assert len(timing.times) > 1, \
+                'body arrived in %d chunk, min_gap_ms needs two' % (
+                    len(timing.times))
+            assert min(timing.gaps()) >= float(min_gap), \
+                'chunks arrived [%s] ms apart, < %s ms' % (gaps, min_gap)
+        max_gap = Lexer.get_option_value(item.option, 'max_gap_ms')
+        if max_gap is not None and len(timing.times) > 1:
+            assert max(timing.gaps()) <= float(max_gap), \
+                'chunks arrived [%s] ms apart, > %s ms' % (gaps, max_gap)
 
     def assert_response_headers(self, r, item):
-        headers = get_headers(item.value)
-        for k, v in headers.iteritems():
+        for k, v in self.expected(item).iteritems():
             self.more_assert(v, r.headers[k], item.option)
 
     def assert_status_code(self, r, item):
-        self.more_assert(int(item.value), r.status_code, item.option)
+        self.more_assert(self.expected(item), r.status_code, item.option)
 
     def assert_error_log(self, _, item):
-        if isinstance(item.value, list):
-            for p in item.value:
-                m = re.search(p, self.error_log)
-                assert m, 'error log<%s> not found: %s' % (p, self.error_log)
-        else:
-            m = re.search(item.value, self.error_log)
-            assert m, 'error log<%s> not found: %s' % (item.value,
-                                                       self.error_log)
+        patterns = self.expected(item)
+        if not isinstance(patterns, list):
+            patterns = [patterns]
+        for p in patterns:
+            assert p.search(self.error_log), 'error log<%s> not found: %s' % (
+                p.pattern, self.error_log)
 
     def assert_no_error_log(self, _, item):
-        level = None
-        error_level = ['warn', 'error', 'crit', 'alert', 'emerg']
-        if isinstance(item.value, str):
-            if item.value in error_level:
-                level = error_level[error_level.index(item.value):]
-            else:
-                level = [item.value]
-        elif item.value is None:
-            level = error_level[1:]
-        m = re.search(r'.+?\[(%s)\]' % '|'.join(level), self.error_log)
+        m = self.expected(item).search(self.error_log)
         assert not m, 'error log found: ' + m.string
 
+    def usage_pair(self):
+        before = self.locals.get('usage_before')
+        assert before is not None, 'nginx usage not available from /proc'
+        after = self.sample_usage()
+        assert after is not None, 'nginx is not running'
+        return before, after
+
+    def assert_max_worker_rss_kb(self, _, item):
+        _, after = self.usage_pair()
+        rss = after.max_worker_rss_kb()
+        assert rss <= self.expected(item), 'worker rss %d kB > %s kB' % (
+            rss, item.value)
+
+    def assert_max_cpu_ms(self, _, item):
+        before, after = self.usage_pair()
+        cpu = after.cpu_ms(before)
+        assert cpu <= self.expected(item), 'nginx cpu %d ms > %s ms' % (
+            cpu, item.value)
+
+    def assert_no_fd_leak(self, _, item):
+        """ Fail when nginx holds more than `item.value` (default 0) fds
+            above the start of the case, closed connections are given a
+            moment to go away.
+        """
+        tolerance = self.expected(item)
+        self.close_connections()
+        for _ in range(10):
+            before, after = self.usage_pair()
+            growth = [g for g in after.fd_growth(before)
+                      if g[2] - g[1] > tolerance]
+            if not growth:
+                return
+            sleep(0.05)
+        raise AssertionError('nginx fd leak (pid, before, after): %s' %
+                             growth)
+
+    def close_connections(self):
+        """ Close the connections the case keeps alive to nginx, the
+            sessions are created again by the next request.
+        """
+        if self.raw_conn is not None:
+            self.raw_conn.close()
+        if self.session is not None:
+            self.session.close()
+            self.session = None
+        close_tls_client()
+
     def do_assert(self, item):
         if item.name in self.exec_items or 'exec' in item.option:
             return self._exec(item.value)
+        if item.name in self.usage_items:
+            return getattr(self, 'assert_' + item.name)(None, item)
 
         r = self.locals['r']
         assert r is not None, 'no request found'
 
-        if (isinstance(r, list) or isinstance(item.value, list)) and \
-                not isinstance(r, type(item.value)):
+        listed = isinstance(item.value, list) and not (
+            item.name in self.list_valued_items and not isinstance(r, list))
+        if isinstance(r, list) != listed:
             raise Exception('unmatched assert')
         if isinstance(r, list):
             for idx, _r in enumerate(r):
                 _item = copy.deepcopy(item)
                 _item.value = item.value[idx]
+                _item.expected = None
                 getattr(self, 'assert_' + item.name)(_r, _item)
         else:
             getattr(self, 'assert_' + item.name)(r, item)
 
+    def rounds(self):
+        if os.environ.get('ZTEST_CHECK_LEAK') == '1':
+            return int(os.environ.get('ZTEST_CHECK_LEAK_ROUNDS', leak_rounds))
+        return int(os.environ.get('ZTEST_REPEAT_EACH', 1))
+
     def test_run(self):
+        """ Run the request and assert blocks, again for every round of
+            ZTEST_REPEAT_EACH or ZTEST_CHECK_LEAK, without a new setup or
+            config. The shell, setenv and reload items before the first
+            request run once before the rounds, later ones in the first
+            round only. A leak check samples the worker RSS after each
+            round.
+        """
         if self.skip or self.items is None:
             return
+        items, samples = self.items, []
+        check_leak = os.environ.get('ZTEST_CHECK_LEAK') == '1'
+        start = 0
+        while start < len(items) and items[start].name in self.alone_items:
+            start += 1
+        if start:
+            self.items = [copy.copy(i) for i in items[:start]]
+            self.run_blocks()
+        for n in range(self.rounds()):
+            self.error_log = ''
+            self.items = [copy.copy(i) for i in items[start:]]
+            self.run_blocks(repeat=n > 0)
+            if check_leak:
+                usage = self.sample_usage()
+                assert usage is not None, 'nginx usage not available'
+                samples.append(usage.max_worker_rss_kb())
+        self.items = items
+
+        before = self.locals.get('usage_before')
+        if before is not None:
+            after = self.sample_usage()
+            if after is not None:
+                self.usage = after.as_dict(before)
+
+        if check_leak:
+            self.locals['leak_samples'] = samples
+            growth = leaking(samples, float(os.environ.get(
+                'ZTEST_CHECK_LEAK_WARMUP', leak_warmup)), int(os.environ.get(
+                    'ZTEST_CHECK_LEAK_KB', leak_threshold_kb)))
+            assert growth is None, 'worker rss grew by %d kB: %s' % (
+                growth, samples)
+
+    def run_blocks(self, repeat=False):
         for block in self._blocks():
+            if repeat and not isinstance(block, dict) and \
+                    block.name in self.alone_items:
+                continue
+            if isinstance(block, dict) or block.name != 'shell':
+                self.shell_wait()
             if isinstance(block, dict):
-                if block.get('request') is None:
+                if 'pipelined_requests' in block:
+                    r = self.do_pipelined_requests(block)
+                elif 'raw_request' in block:
+                    if isinstance(block['raw_request'].value, list):
+                        r = self.do_raw_requests(block)
+                    else:
+                        r = self.do_raw_request(block)
+                elif block.get('request') is None:
                     raise Exception('no request found')
-                if isinstance(block['request'].value, list):
+                elif isinstance(block['request'].value, list):
                     r = self.do_requests(block)
                 elif isinstance(block['request'].value, str):
                     r = self.do_request(block)
@@ -472,44 +2692,481 @@ class TestNginx(ContextTestCase):
                 getattr(self, block.name)(block)
             else:
                 try:
-                    self.do_assert(block)
+                    with self.phase('assert', '%s:%d' % (block.name,
+                                                         block.lineno)):
+                        self.do_assert(block)
                 except:
-                    LOG_ERR('%s at line: %d' % (block.name, block.lineno))
+                    LOG_ERR('%s at line: %d%s' % (
+                        block.name, block.lineno,
+                        ' of ' + block.source if hasattr(block, 'source')
+                        else ''))
                     raise
+        self.shell_wait()
 
 
-def run_test_suite(suite):
-    r = unittest.TextTestRunner(verbosity=2).run(suite)
-    if r and (r.errors or r.failures):
-        sys.exit(1)
+class Fixture(object):
+    """ A global env and setup shared by every file declaring the same code
+        with a scope wider than the file, built once and torn down when
+        its scope ends.
+    """
+    def __init__(self, scope, env, setup, base):
+        self.scope = scope
+        self.env = env
+        self.setup = setup
+        self.namespace = dict(base)
+        self.teardowns = []
+        self.built = False
+        self.error = None
+
+    def build(self):
+        if not self.built:
+            self.built = True
+            try:
+                for code in (self.env, self.setup):
+                    if code:
+                        exec(compile_code(code), self.namespace, None)
+            except KeyboardInterrupt:
+                raise
+            except:
+                self.error = sys.exc_info()
+        return self.error is None
+
+    def add_teardown(self, code):
+        if code and code not in self.teardowns:
+            self.teardowns.append(code)
+
+    def close(self):
+        errors = []
+        if self.built and self.error is None:
+            for code in self.teardowns:
+                try:
+                    exec(compile_code(code), self.namespace, None)
+                except KeyboardInterrupt:
+                    raise
+                except:
+                    errors.append(sys.exc_info())
+        return errors
+
+
+class Fixtures(object):
+    """ Fixtures by scope and content hash of their env and setup code.
+        The standalone runner is a single worker, so its session and
+        worker scopes both end with the run.
+    """
+    scopes = ['file', 'worker', 'session']
+
+    def __init__(self):
+        self.fixtures = []
+        self.index = {}
+
+    def get(self, scope, g, base):
+        key = (scope, hashlib.sha1(json.dumps(
+            [g.get('env'), g.get('setup')])).hexdigest())
+        if key not in self.index:
+            self.index[key] = Fixture(scope, g.get('env'), g.get('setup'),
+                                      base)
+            self.fixtures.append(self.index[key])
+        return self.index[key]
+
+    def close(self, scope=None):
+        """ Tear down the fixtures of `scope`, or of every scope, newest
+            first, and return the errors.
+        """
+        errors = []
+        for fixture in reversed(self.fixtures[:]):
+            if scope is None or fixture.scope == scope:
+                errors.extend(fixture.close())
+                self.fixtures.remove(fixture)
+        return errors
+
+
+class FileError(object):
+    """ Stands for the env, setup or teardown of a .zt file where a result
+        expects a test, to report their errors.
+    """
+    failureException = AssertionError
+
+    def __init__(self, description):
+        self.description = description
+
+    def id(self):
+        return self.description
+
+    def shortDescription(self):
+        return None
 
+    def __str__(self):
+        return self.description
 
-def run_tests():
+
+class FileSuite(unittest.TestSuite):
+    """ Tests of one .zt file, its global env and setup run before the
+        first test and its teardown after the last one. A setup declared
+        with `scope=worker` or `scope=session` comes from `fixtures`.
+    """
+    def __init__(self, zt, g, env, tests=(), pending=0, options=None,
+                 fixtures=None):
+        super(FileSuite, self).__init__(tests)
+        self.zt = zt
+        self.g = g
+        self.env = env
+        self.pending = pending
+        self.options = options or {}
+        self.fixtures = fixtures
+
+    def scope(self, name):
+        """ The scope of the setup or the teardown, a teardown has the
+            scope of the setup it undoes.
+        """
+        default = self.scope('setup') if name == 'teardown' else 'file'
+        scope = Lexer.get_option_value(self.options.get(name, []), 'scope',
+                                       default)
+        if scope not in Fixtures.scopes:
+            raise Exception('unknown scope of %s in %s: %s' % (
+                name, self.zt, scope))
+        if name == 'teardown' and scope != default:
+            raise Exception('teardown scope %s differs from setup scope %s '
+                            'in %s' % (scope, default, self.zt))
+        return scope
+
+    def _error(self, name, exc_info, result):
+        result.addError(FileError('%s (%s)' % (name, self.zt)), exc_info)
+
+    def _exec(self, name, result):
+        if not self.g.get(name):
+            return True
+        try:
+            exec(compile_code(self.g[name]), self.env, None)
+        except KeyboardInterrupt:
+            raise
+        except:
+            self._error(name, sys.exc_info(), result)
+            return False
+        return True
+
+    def setup(self, result):
+        """ Run the env and setup of the file, or take them from a wider
+            fixture, errors go to `result`.
+        """
+        try:
+            scope = self.scope('setup')
+            self.scope('teardown')
+        except Exception:
+            self._error('setup', sys.exc_info(), result)
+            return False
+        if scope == 'file' or self.fixtures is None:
+            return self._exec('env', result) and self._exec('setup', result)
+
+        fixture = self.fixtures.get(scope, self.g, self.env)
+        if not fixture.build():
+            self._error('setup', fixture.error, result)
+            return False
+        self.env.update(fixture.namespace)
+        if self.scope('teardown') != 'file':
+            fixture.add_teardown(self.g.get('teardown'))
+        return True
+
+    def run(self, result):
+        if result.shouldStop:
+            return result
+        if not self.pending:
+            # nothing to run, report the skipped cases without the setup
+            return super(FileSuite, self).run(result)
+        if not self.setup(result):
+            return result
+        try:
+            super(FileSuite, self).run(result)
+        finally:
+            self.teardown(result)
+        return result
+
+    def teardown(self, result):
+        try:
+            scope = self.scope('teardown')
+        except Exception:
+            return  # reported by the setup
+        if scope == 'file' or self.fixtures is None:
+            self._exec('teardown', result)
+
+
+def run_test_suite(suite, recorders=(), failfast=False):
+    r = unittest.TextTestRunner(stream=sys.stderr, verbosity=2,
+                                resultclass=TimingResult,
+                                failfast=failfast).run(suite)
+    for recorder in recorders:
+        recorder.record(suite, r)
+    return r
+
+
+def collect_tests():
+    """ Gather, parse, select and shard the .zt files without touching
+        nginx, return the files as (zt, globals, options, cases) and the
+        timings.
+    """
     td = os.environ.get('ZTEST_DIR')
     if td is None:
         td = test_directory
 
-    zts = gather_files(td)
-    if not zts:
+    run_only = os.environ.get('ZTEST_RUN_ONLY')
+    files = [(zt,) + load_test_file(zt, run_only) for zt in gather_files(td)]
+
+    timings = None
+    if os.environ.get('ZTEST_TIMINGS'):
+        timings = Timings(os.environ['ZTEST_TIMINGS'])
+
+    if os.environ.get('ZTEST_SHARD'):
+        index, total = parse_shard(os.environ['ZTEST_SHARD'])
+        mine = shard_cases([case_id(zt, c) for zt, _, _, cases in files
+                            for c in cases if not isinstance(c, MatrixCases)],
+                           index, total, timings)
+        files = [(zt, g, o, [c.sharded(index, total)
+                             if isinstance(c, MatrixCases) else c
+                             for c in cases if isinstance(c, MatrixCases) or
+                             case_id(zt, c) in mine])
+                 for zt, g, o, cases in files]
+
+    return files, timings
+
+
+def list_tests(out=None):
+    out = out or sys.stdout
+    files, _ = collect_tests()
+    for zt, _, _, cases in files:
+        for case in cases:
+            names = case.names() if isinstance(case, MatrixCases) else \
+                [case.name]
+            for name in names:
+                out.write('%s:%d: %s\n' % (zt, case.lineno, name))
+
+
+def run_tests():
+    files, timings = collect_tests()
+    if not files:
         return
 
-    for zt in zts:
-        env, suite = {'TestNginx': TestNginx}, unittest.TestSuite()
-        g, cases = Cases()(Lexer()(open(zt).read()))
+    cache = None
+    if os.environ.get('ZTEST_CACHE') == '1':
+        cache = ResultCache(os.environ.get('ZTEST_CACHE_FILE', cache_file),
+                            force=os.environ.get('ZTEST_FORCE') == '1')
+
+    recorders = filter(None, [cache, timings])
+    if os.environ.get('ZTEST_JUNIT') or os.environ.get('ZTEST_JSON'):
+        recorders.append(Report(os.environ.get('ZTEST_JUNIT'),
+                                os.environ.get('ZTEST_JSON')))
+
+    bench = None
+    if os.environ.get('ZTEST_BENCH') == '1':
+        bench = BenchStore(
+            os.environ.get('ZTEST_BENCH_FILE', bench_file), files,
+            rev=os.environ.get('ZTEST_BENCH_REV'),
+            tolerance=BenchStore.parse_tolerance(
+                os.environ.get('ZTEST_BENCH_TOLERANCE')))
+        recorders.append(bench)
+
+    batch = os.environ.get('ZTEST_BATCH') == '1'
+    fixtures = Fixtures()
+    suite = unittest.TestSuite()
+    for zt, g, options, cases in files:
+        if not cases:
+            continue
+        env = {'TestNginx': TestNginx, 'spawn': spawn}
+        fs = FileSuite(zt, g, env, options=options, fixtures=fixtures)
+        fs.pending = add_test_case(zt, fs, cases, env, cache=cache, g=g,
+                                   batch=batch)
+        suite.addTest(fs)
+
+    try:
+        r = run_test_suite(suite, recorders,
+                           failfast=os.environ.get('ZTEST_FAIL_FAST') == '1')
+    finally:
+        for recorder in recorders:
+            recorder.save()
+        errors = fixtures.close()
+        for exc_info in errors:
+            LOG_ERR('fixture teardown failed:\n' +
+                    ''.join(traceback.format_exception(*exc_info)))
+
+    regressions = []
+    if bench is not None and os.environ.get('ZTEST_BENCH_BASELINE'):
+        regressions = bench.compare(os.environ['ZTEST_BENCH_BASELINE'])
+        for regression in regressions:
+            LOG_ERR('performance regression: ' + regression)
+
+    if r.errors or r.failures or errors or regressions:
+        sys.exit(1)
 
-        if g.get('env'):
-            exec(g['env'], env, None)
-        if g.get('setup'):
-            exec(g['setup'], env, None)
 
-        run_only = os.environ.get('ZTEST_RUN_ONLY')
-        add_test_case(zt, suite, cases, env, run_only=run_only)
+class ClientStream(object):
+    """ stdout or stderr of a daemon run, written to the client as JSON
+        lines tagged with the stream name.
+    """
+    def __init__(self, wfile, name):
+        self.wfile = wfile
+        self.name = name
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.decode('utf-8', 'replace')
+        self.wfile.write(json.dumps({'stream': self.name, 'data': data}) +
+                         '\n')
+
+    def flush(self):
+        self.wfile.flush()
+
+
+@contextlib.contextmanager
+def redirected(out, err, env):
+    """ Run with `out` and `err` as stdout and stderr, including the
+        console logger, and `env` as the ZTEST_* environment.
+    """
+    global logger
+    if logger is None:
+        logger = get_console_logger('ztest')
+    saved = sys.stdout, sys.stderr, dict(os.environ)
+    streams = [(h, h.stream) for h in logger.handlers]
+    sys.stdout, sys.stderr = out, err
+    for h, _ in streams:
+        h.stream = err
+    for k in os.environ.keys():
+        if k.startswith('ZTEST_'):
+            del os.environ[k]
+    os.environ.update(env)
+    try:
+        yield
+    finally:
+        sys.stdout, sys.stderr = saved[:2]
+        for h, stream in streams:
+            h.stream = stream
+        os.environ.clear()
+        os.environ.update(saved[2])
+
+
+def begin_run():
+    """ Drop what a daemon must not carry from one run to the next: the
+        parsed files that were removed, and the interned values and their
+        digests, which would otherwise pin every version of edited files.
+    """
+    intern_table.clear()
+    _digests.clear()
+    for zt in [zt for zt in _loaded if not os.path.exists(zt)]:
+        del _loaded[zt]
+
+
+def serve(path):
+    """ Serve runs on the Unix socket `path` until stopped. The daemon
+        keeps the parsed files, the compiled code and the nginx master
+        between runs, and runs one request at a time as they share nginx.
+        Every case still loads its config with a reload, as a standalone
+        run does, so that no worker carries state from another case.
+    """
+    import SocketServer
+
+    class Handler(SocketServer.StreamRequestHandler):
+        def handle(self):
+            request = json.loads(self.rfile.readline())
+            out = ClientStream(self.wfile, 'stdout')
+            err = ClientStream(self.wfile, 'stderr')
+            command, status = request.get('command'), 0
+            if request.get('cwd') != os.getcwd():
+                err.write('ztest daemon serves %s\n' % os.getcwd())
+                status = 2
+            elif command == 'stop':
+                threading.Thread(target=self.server.shutdown).start()
+            else:
+                with redirected(out, err, request.get('env', {})):
+                    begin_run()
+                    try:
+                        if command == 'list':
+                            list_tests(out)
+                        else:
+                            run_tests()
+                    except SystemExit as e:
+                        status = e.code if isinstance(e.code, int) else 1
+                    except Exception:
+                        err.write(traceback.format_exc())
+                        status = 1
+            self.wfile.write(json.dumps({'exit': status}) + '\n')
+
+    if connect_daemon(path) is not None:
+        raise Exception('a ztest daemon already serves %s' % path)
+    if os.path.exists(path):
+        os.unlink(path)
+    server = SocketServer.UnixStreamServer(path, Handler)
+    # stop once the current run ends, SocketServer swallows exceptions
+    signal.signal(signal.SIGTERM, lambda *args: threading.Thread(
+        target=server.shutdown).start())
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.unlink(path)
+        Nginx(TestNginx.nginx_prefix, TestNginx.nginx_bin).stop()
+
+
+def connect_daemon(path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error:
+        sock.close()
+        return None
+    return sock
+
+
+def submit(sock, command):
+    """ Send `command` with the ZTEST_* environment to the daemon on
+        `sock`, relay its output and return its exit status.
+    """
+    env = dict((k, v) for k, v in os.environ.items()
+               if k.startswith('ZTEST_') and k != 'ZTEST_DAEMON')
+    sock.sendall(json.dumps({'command': command, 'cwd': os.getcwd(),
+                             'env': env}) + '\n')
+    status = 1
+    for line in sock.makefile('rb'):
+        msg = json.loads(line)
+        if 'exit' in msg:
+            status = msg['exit']
+            break
+        stream = sys.stdout if msg['stream'] == 'stdout' else sys.stderr
+        stream.write(msg['data'].encode('utf-8'))
+        stream.flush()
+    sock.close()
+    return status
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Run ztest suites against nginx, the suites and the '
+                    'run are selected with ZTEST_* environment variables.')
+    parser.add_argument('--list', '--collect-only', dest='list',
+                        action='store_true',
+                        help='list the selected cases, without nginx')
+    parser.add_argument('--serve', action='store_true',
+                        help='run as a daemon keeping suites parsed and '
+                             'nginx running, on the ZTEST_DAEMON socket')
+    parser.add_argument('--stop', action='store_true',
+                        help='stop the daemon')
+    args = parser.parse_args(argv)
+
+    path = os.environ.get('ZTEST_DAEMON')
+    if args.serve:
+        return serve(path or daemon_socket)
+
+    command = 'stop' if args.stop else 'list' if args.list else 'run'
+    sock = connect_daemon(path or daemon_socket) \
+        if path or args.stop else None
+    if sock is not None:
+        sys.exit(submit(sock, command))
+    if args.stop:
+        return
 
-        try:
-            run_test_suite(suite)
-        finally:
-            if g.get('teardown'):
-                exec(g['teardown'], env, None)
+    if args.list:
+        list_tests()
+    else:
+        run_tests()
 
 
-run_tests()
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,27 @@
+import os
+import sys
+import json
+import socket
+import shutil
+import tempfile
+import threading
+import itertools
 import unittest
 from functools import wraps
-from ztest import Lexer, LexerException, Cases
+from ztest import Lexer, LexerException, Cases, InternTable, Fragments, \
+    Template, ContextTestCase, ContextSuite
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'examples'))
+import ztest_nginx  # noqa: E402
+
+
+def imports(name):
+    try:
+        __import__(name)
+    except ImportError:
+        return False
+    return True
 
 
 def get_tokens(verbose=False, raises=None, raises_regexp=None):
@@ -97,6 +118,109 @@ import sys
         self.assertEqual(tokens[3].type, Lexer.CASE_LINE)
         self.assertEqual(tokens[3].value, None)
 
+    def test_globals_04(self):
+        cases = Cases()
+        cases(Lexer()('''
+--- env
+import sys
+--- setup scope=session
+0
+=== TEST 1.0:
+'''))
+
+        self.assertEqual(cases.globals['setup'], '0')
+        self.assertEqual(cases.options['env'], [])
+        self.assertEqual(cases.options['setup'], ['scope=session'])
+
+    def test_intern_00(self):
+        text = '''
+=== TEST 1:
+--- config eval
+"location / {}"
+--- request
+GET /
+
+=== TEST 2:
+--- config eval
+"location / {}"
+--- request
+GET /
+'''
+        table = InternTable()
+        _, cases = Cases(table)(Lexer()(text))
+        _, more = Cases(table)(Lexer()(text))
+
+        self.assertEqual(len(cases), 2)
+        for case in cases[1:] + more:
+            for a, b in zip(cases[0].items, case.items):
+                self.assertEqual(a.value, b.value)
+                self.assertTrue(a.value is b.value)
+                self.assertTrue(a.option is b.option)
+        self.assertEqual(cases[0].items[0].option, ['eval'])
+        self.assertEqual(len(table), 4)
+
+    @get_cases()
+    def test_matrix_00(self, globals=None, cases=None):
+        '''
+=== TEST 1: status {{code}}
+--- matrix
+({'code': c, 'path': p} for c in (200, 204) for p in ('a', 'b'))
+--- config
+location /{{path}} { return {{code}}; }
+--- request
+GET /{{path}}?{{missing}}
+--- status_code: {{code}}
+
+=== TEST 2: sizes
+--- matrix
+[{'size': 1}, {'size': 1024, 'unit': 'b'}]
+--- request
+GET /t?size={{size}}
+'''
+        self.assertEqual(len(cases), 2)
+        self.assertTrue(isinstance(cases[0], Template))
+        self.assertEqual([i.name for i in cases[0].items],
+                         ['config', 'request', 'status_code'])
+        self.assertEqual(cases[0].matrix.lineno, 3)
+
+        self.assertEqual(list(cases[0].names()), [
+            'TEST 1: status 200 path=a', 'TEST 1: status 200 path=b',
+            'TEST 1: status 204 path=a', 'TEST 1: status 204 path=b'])
+        self.assertEqual(list(cases[1].names()), [
+            'TEST 2: sizes size=1', 'TEST 2: sizes size=1024 unit=b'])
+
+        case = list(cases[0].expand(lambda name: '204' in name))[1]
+        self.assertEqual(case.name, 'TEST 1: status 204 path=b')
+        self.assertEqual(case.lineno, 2)
+        self.assertEqual([i.value for i in case.items], [
+            'location /b { return 204; }', 'GET /b?{{missing}}', '204'])
+        self.assertEqual(cases[0].items[0].value,
+                         'location /{{path}} { return {{code}}; }')
+
+    def test_matrix_01(self):
+        _, cases = Cases()(Lexer()('''
+=== TEST 1: endless
+--- matrix
+({'n': n} for n in count())
+--- request
+GET /{{n}}
+'''))
+        cases = cases[0].expand(lambda name: name.endswith('0'),
+                                {'count': itertools.count})
+        self.assertEqual([c.items[0].value for c in
+                          itertools.islice(cases, 3)],
+                         ['GET /0', 'GET /10', 'GET /20'])
+
+    @get_tokens()
+    def test_matrix_02(self, tokens=None):
+        '''
+=== TEST 1: two
+--- matrix: [{}]
+--- matrix: [{}]
+'''
+        self.assertRaisesRegexp(LexerException, 'more than one matrix',
+                                Cases(), tokens)
+
     @get_tokens()
     def test_case_00(self, tokens=None):
         '''
@@ -429,6 +553,49 @@ gzip on;
         self.assertEqual(tokens[4].value, '''"""
 --- request"""''')
 
+    @get_tokens()
+    def test_case_14(self, tokens=None):
+        '''
+=== TEST 1: long item names
+--- response_body_sha256_of_a_very_long_item_name
+0123
+--- response_body_sha256_of_a_very_long_item_name stream like
+0123
+'''
+
+        self.assertEqual(len(tokens), 3)
+
+        self.assertEqual(tokens[1].name,
+                         'response_body_sha256_of_a_very_long_item_name')
+        self.assertEqual(tokens[1].option, [])
+        self.assertEqual(tokens[1].value, '0123')
+
+        self.assertEqual(tokens[2].option, ['stream', 'like'])
+        self.assertEqual(tokens[2].value, '0123')
+
+    @get_tokens()
+    def test_case_15(self, tokens=None):
+        '''
+=== TEST 1: option values
+--- shell background timeout=1.5 name=seed: echo 1
+--- config include=t/conf/a.zt
+'''
+
+        self.assertEqual(len(tokens), 3)
+
+        self.assertEqual(tokens[1].name, 'shell')
+        self.assertEqual(tokens[1].option,
+                         ['background', 'timeout=1.5', 'name=seed'])
+        self.assertEqual(tokens[1].value, 'echo 1')
+        self.assertEqual(
+            Lexer.get_option_value(tokens[1].option, 'timeout'), '1.5')
+        self.assertEqual(
+            Lexer.get_option_value(tokens[1].option, 'scope', 'case'), 'case')
+
+        self.assertEqual(tokens[2].name, 'config')
+        self.assertEqual(tokens[2].option, ['include=t/conf/a.zt'])
+        self.assertEqual(tokens[2].value, None)
+
     @get_tokens()
     def test_delimiter_00(self, tokens=None):
         '''
@@ -657,5 +824,612 @@ __EOF__
 '''
 
 
+class TestInclude(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='ztest-')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, name, text):
+        path = os.path.join(self.dir, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        open(path, 'w').write(text)
+        return path
+
+    def parse(self, path, deps=None):
+        tokens = Fragments().expand(Lexer()(open(path).read()), path,
+                                    deps=deps)
+        return Cases(InternTable())(tokens)
+
+    def test_include_00(self):
+        self.write('inc/env.zt', '''--- env
+import os
+
+--- setup
+x = 1
+''')
+        self.write('inc/conf.zt', '''// shared config
+--- config
+location /t {
+    return 200;
+}
+''')
+        path = self.write('a.zt', '''--- include: inc/env.zt
+
+=== TEST 1: include
+--- include
+inc/conf.zt
+--- request
+GET /t
+
+=== TEST 2: include option
+--- config include=inc/conf.zt
+location /u {
+    return 204;
+}
+--- request
+GET /u
+''')
+        deps = []
+        g, cases = self.parse(path, deps)
+
+        self.assertEqual(g, {'env': 'import os', 'setup': 'x = 1'})
+        self.assertEqual(deps, [os.path.join(self.dir, 'inc/env.zt'),
+                                os.path.join(self.dir, 'inc/conf.zt')])
+        self.assertEqual(len(cases), 2)
+
+        config = cases[0].items[0]
+        self.assertEqual(config.type, Lexer.ITEM)
+        self.assertEqual(config.name, 'config')
+        self.assertEqual(config.lineno, 2)
+        self.assertEqual(config.source, deps[1])
+        self.assertEqual(cases[0].items[1].name, 'request')
+        self.assertFalse(hasattr(cases[0].items[1], 'source'))
+
+        config = cases[1].items[0]
+        self.assertEqual(config.option, [])
+        self.assertEqual(config.lineno, 10)
+        self.assertEqual(config.value, '''location /t {
+    return 200;
+}
+location /u {
+    return 204;
+}''')
+
+    def test_include_01(self):
+        self.write('a.zt', '--- include: b.zt\n')
+        self.write('b.zt', '--- include: c.zt\n')
+        path = self.write('c.zt', '--- include: a.zt\n')
+        self.assertRaisesRegexp(LexerException, 'include cycle: .*c.zt -> '
+                                '.*a.zt -> .*b.zt -> .*c.zt$',
+                                self.parse, path)
+
+    def test_include_02(self):
+        self.write('b.zt', '=== TEST 1: case\n--- request\nGET /\n')
+        path = self.write('a.zt', '''--- include: b.zt
+''')
+        self.assertRaisesRegexp(LexerException, 'b.zt:1: test case',
+                                self.parse, path)
+
+        self.write('b.zt', '--- env\nimport os\n')
+        path = self.write('a.zt', '''
+=== TEST 1: missing
+--- config include=b.zt
+''')
+        self.assertRaisesRegexp(LexerException, 'a.zt:3: no config item',
+                                self.parse, path)
+
+        path = self.write('a.zt', '''
+=== TEST 1: missing
+--- include: c.zt
+''')
+        self.assertRaisesRegexp(LexerException, 'a.zt:3: included file not',
+                                self.parse, path)
+
+    def test_include_03(self):
+        fragments = Fragments()
+        path = self.write('b.zt', '--- config\nlocation / {}\n')
+        tokens = fragments.load(path)
+        self.assertTrue(fragments.load(path) is tokens)
+        self.write('b.zt', '--- config\nlocation /b {}\n')
+        self.assertFalse(fragments.load(path) is tokens)
+        self.assertEqual(fragments.load(path)[0].value, 'location /b {}')
+
+
+class TestContextSuite(unittest.TestCase):
+    class Context(ContextTestCase):
+        def test_run(self):
+            self.ctx.append('run')
+
+    def test_context_suite_00(self):
+        contexts = [[], [], []]
+        suite = ContextSuite(self.Context, 'test_run', contexts[:2])
+        suite.addContext(contexts[2])
+
+        self.assertEqual(suite.countTestCases(), 3)
+        self.assertFalse(any(isinstance(t, ContextTestCase)
+                             for t in suite._tests))
+        first = next(iter(suite))
+        self.assertTrue(first.ctx is contexts[0])
+        self.assertEqual(len([t for t in suite._tests
+                              if isinstance(t, ContextTestCase)]), 1)
+
+        result = unittest.TestResult()
+        suite.run(result)
+        self.assertEqual(result.testsRun, 3)
+        self.assertEqual(contexts, [['run']] * 3)
+        self.assertTrue(list(suite)[0] is first)
+
+    def test_context_suite_01(self):
+        ctx = []
+        a = self.Context('test_run', ctx=ctx)
+        self.assertEqual(a, self.Context('test_run', ctx=ctx))
+        self.assertNotEqual(a, self.Context('test_run', ctx=[]))
+        self.assertEqual(len(set([a, self.Context('test_run', ctx=ctx),
+                                  self.Context('test_run', ctx=[])])), 2)
+
+
+class TestNginxAssert(unittest.TestCase):
+    class Item(object):
+        def __init__(self, name, value, option=None, lineno=1):
+            self.name, self.value, self.lineno = name, value, lineno
+            self.option = option or []
+
+    class Response(object):
+        def __init__(self, chunks, times):
+            timing = ztest_nginx.StreamTiming(0, 0, keep=True)
+            timing.data, timing.times = chunks, times
+            timing.ttfb_ms = times[0] if times else None
+            timing.finish()
+            self.stream_timing = timing
+
+    def assert_item(self, r, item):
+        t = ztest_nginx.TestNginx('test_run')
+        t.locals = {'r': r}
+        t.do_assert(item)
+
+    def test_chunks_00(self):
+        r = self.Response(['1', '2', '3'], [10.0, 110.0, 210.0])
+        self.assert_item(r, self.Item('chunks', ['1', '2', '3'],
+                                      ['eval', 'min_gap_ms=80']))
+        self.assert_item(r, self.Item('chunks', '3', ['max_gap_ms=100']))
+        self.assertRaises(AssertionError, self.assert_item, r,
+                          self.Item('chunks', ['12', '3'], ['eval']))
+        self.assertRaisesRegexp(AssertionError, '3 chunks, expected 2',
+                                self.assert_item, r, self.Item('chunks', '2'))
+        self.assertRaisesRegexp(AssertionError, '> 50 ms', self.assert_item,
+                                r, self.Item('chunks', '', ['max_gap_ms=50']))
+
+    def test_max_ttfb_ms_00(self):
+        r = self.Response(['1'], [25.0])
+        self.assert_item(r, self.Item('max_ttfb_ms', '30'))
+        self.assertRaisesRegexp(AssertionError, r'ttfb 25.0 ms > 20.0 ms',
+                                self.assert_item, r,
+                                self.Item('max_ttfb_ms', 20, ['eval']))
+
+    def test_chunks_01(self):
+        r = self.Response(['123'], [10.0])
+        self.assertRaisesRegexp(AssertionError, 'min_gap_ms needs two',
+                                self.assert_item, r,
+                                self.Item('chunks', '', ['min_gap_ms=80']))
+        r = self.Response(['1', '23'], [10.0, 12.0])
+        self.assertRaisesRegexp(AssertionError, r'\[2.0\] ms apart, < 80',
+                                self.assert_item, r,
+                                self.Item('chunks', '', ['min_gap_ms=80']))
+
+    def test_repeat_00(self):
+        t = ztest_nginx.TestNginx('test_run')
+        t.skip, t.globals, t.phases, t.jobs = False, {}, [], []
+        t.locals = {'calls': []}
+        t.items = [self.Item('setenv', 'calls.append("setenv")'),
+                   self.Item('assert', 'calls.append("assert")'),
+                   self.Item('setenv', 'calls.append("late")'),
+                   self.Item('assert', 'calls.append("assert")')]
+        saved = os.environ.get('ZTEST_REPEAT_EACH')
+        os.environ['ZTEST_REPEAT_EACH'] = '3'
+        try:
+            t.test_run()
+        finally:
+            os.environ.pop('ZTEST_REPEAT_EACH')
+            if saved is not None:
+                os.environ['ZTEST_REPEAT_EACH'] = saved
+        self.assertEqual(t.locals['calls'], ['setenv', 'assert', 'late',
+                                             'assert'] + ['assert'] * 4)
+
+    def test_chunks_02(self):
+        r = [self.Response(['1', '2'], [1.0, 2.0]),
+             self.Response(['3'], [1.0])]
+        self.assert_item(r, self.Item('chunks', [['1', '2'], ['3']],
+                                      ['eval']))
+        self.assertRaisesRegexp(Exception, 'unmatched assert',
+                                self.assert_item, r, self.Item('chunks', '2'))
+
+
+class TestStreamSearch(unittest.TestCase):
+    def search(self, pattern, chunks, option=None):
+        s = ztest_nginx.StreamSearch(pattern, option or ['like'])
+        for chunk in chunks:
+            s.update(chunk)
+            self.assertTrue(len(s.tail) < ztest_nginx.stream_match_max)
+        s.finish()
+        return s
+
+    def test_stream_search_00(self):
+        self.assertTrue(self.search('needle', ['xxnee', 'dlexx']).found)
+        s = self.search('needle', ['x' * 70000, 'y' * 70000])
+        self.assertEqual(s.error, 'response body does not match: needle')
+        self.assertEqual(self.search('n', ['abc'], ['unlike']).error, None)
+
+    def test_stream_search_01(self):
+        s = self.search('ne{3}dle', ['xxneee', 'dle'], ['like', 'max_match=3'])
+        self.assertFalse(s.found)
+        s = self.search('ne{3}dle', ['xxneee', 'dle'], ['like', 'max_match=7'])
+        self.assertTrue(s.found)
+
+
+class TestResultCache(unittest.TestCase):
+    def test_result_cache_00(self):
+        path = os.path.join(tempfile.mkdtemp(), 'cache')
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        saved = os.environ.pop('ZTEST_SSL', None)
+        fingerprints = set()
+        try:
+            for ssl in ['0', '1', '1']:
+                os.environ['ZTEST_SSL'] = ssl
+                cache = ztest_nginx.ResultCache(path)
+                fingerprints.add(json.dumps(cache.environment()))
+        finally:
+            os.environ.pop('ZTEST_SSL')
+            if saved is not None:
+                os.environ['ZTEST_SSL'] = saved
+        self.assertEqual(len(fingerprints), 2)
+
+
+class TestBench(unittest.TestCase):
+    def test_mann_whitney_00(self):
+        p = ztest_nginx.mann_whitney_p
+        # normal approximation with continuity correction, as R's
+        # wilcox.test(b, a, alternative='greater', exact=FALSE)
+        self.assertAlmostEqual(p([1, 2, 3], [4, 5, 6]), 0.040428, 6)
+        self.assertAlmostEqual(p([4, 5, 6], [1, 2, 3]), 0.985452, 6)
+        # ties share their mean rank and shrink the variance
+        self.assertAlmostEqual(p([1, 1, 2, 2, 3], [2, 3, 3, 4, 4]),
+                               0.026206, 6)
+        # no variance at all
+        self.assertEqual(p([3, 3, 3], [3, 3]), 1.0)
+
+    def store(self, base, current):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.unlink, path)
+        with open(path, 'w') as fd:
+            for case, latency, cpu_ms in base:
+                fd.write(json.dumps(self.record('base', case, latency,
+                                                cpu_ms)) + '\n')
+        store = ztest_nginx.BenchStore(path, [], rev='head')
+        store.records = [self.record('head', case, latency, cpu_ms)
+                         for case, latency, cpu_ms in current]
+        return store
+
+    @staticmethod
+    def record(rev, case, latency, cpu_ms):
+        return {'rev': rev, 'run': rev, 'case': case, 'fingerprint': 'f',
+                'latency_ms': latency, 'throughput': None,
+                'cpu_ms': cpu_ms, 'rss_kb': None}
+
+    def test_bench_compare_00(self):
+        base = [10.0, 10.2, 9.9, 10.1, 10.3, 9.8]
+        store = self.store(
+            [('a', base, 100), ('b', base, 100), ('c', base, 100)],
+            [('a', [x + 5 for x in base], 100),
+             ('b', [x + 0.5 for x in base], 110),
+             ('c', base, 200), ('d', base, 900)])
+        regressions = store.compare('base')
+        self.assertEqual(len(regressions), 2, regressions)
+        self.assertTrue(regressions[0].startswith(
+            'a: p50 latency 10.00 ms -> 15.00 ms (p='), regressions)
+        self.assertEqual(regressions[1], 'c: cpu_ms 100.00 -> 200.00')
+
+    def test_bench_compare_01(self):
+        # slower by far but too few samples to tell
+        store = self.store([('a', [10.0, 10.1], 100)],
+                           [('a', [20.0, 20.1], 100)])
+        self.assertEqual(store.compare('base'), [])
+
+
+class TestShard(unittest.TestCase):
+    ids = ['t/%02d.zt:TEST_%d' % (i % 7, i) for i in range(200)]
+
+    def shards(self, ids, total, timings=None):
+        return [ztest_nginx.shard_cases(ids, index, total, timings)
+                for index in range(1, total + 1)]
+
+    def test_shard_00(self):
+        self.assertEqual(ztest_nginx.parse_shard(' 2 / 3 '), (2, 3))
+        self.assertEqual(ztest_nginx.parse_shard('3/3'), (3, 3))
+        for spec in ['0/3', '4/3', '1', '1/', 'a/b', '-1/3']:
+            self.assertRaisesRegexp(Exception, 'invalid shard',
+                                    ztest_nginx.parse_shard, spec)
+
+    def test_shard_01(self):
+        timings = dict((i, n % 13 + 0.5) for n, i in enumerate(self.ids)
+                       if n % 3)
+        for t in (None, timings):
+            for total in (1, 3, 8):
+                shards = self.shards(self.ids, total, t)
+                # disjoint and complete
+                self.assertEqual(sum(map(len, shards)), len(self.ids))
+                self.assertEqual(set().union(*shards), set(self.ids))
+                # the order and repetition of the ids do not matter
+                self.assertEqual(self.shards(
+                    self.ids[::-1] + self.ids[:50], total, t), shards)
+
+        for index, shard in enumerate(self.shards(self.ids, 4), 1):
+            self.assertEqual(shard, set(
+                i for i in self.ids if ztest_nginx.in_shard(i, index, 4)))
+
+    def test_shard_02(self):
+        timings = dict((i, 0.1) for i in self.ids)
+        timings.update((i, 5.0) for i in self.ids[:10])
+        for total in (2, 3, 4):
+            loads = [sum(timings[i] for i in shard)
+                     for shard in self.shards(self.ids, total, timings)]
+            self.assertTrue(max(loads) - min(loads) <= 0.1 + 1e-9, loads)
+
+        # the unknown cases weigh the average of the known ones
+        half = dict((i, 2.0) for i in self.ids[:100])
+        sizes = map(len, self.shards(self.ids, 4, half))
+        self.assertEqual(sizes, [50] * 4)
+
+
+class TestFileSuite(unittest.TestCase):
+    def suite(self, options, fixtures):
+        g = {'setup': 'state = ["built"]', 'teardown': 'state.append("down")'}
+        return ztest_nginx.FileSuite('a.zt', g, {}, options=options,
+                                     fixtures=fixtures)
+
+    def test_file_suite_00(self):
+        fixtures = ztest_nginx.Fixtures()
+        for _ in range(2):
+            suite, result = self.suite({'setup': ['scope=session']},
+                                       fixtures), unittest.TestResult()
+            self.assertTrue(suite.setup(result))
+            suite.teardown(result)
+            self.assertEqual(suite.env['state'], ['built'])
+        self.assertEqual(fixtures.close(), [])
+        self.assertEqual(suite.env['state'], ['built', 'down'])
+
+    def test_file_suite_01(self):
+        suite = self.suite({'setup': ['scope=session'],
+                            'teardown': ['scope=file']},
+                           ztest_nginx.Fixtures())
+        result = unittest.TestResult()
+        self.assertFalse(suite.setup(result))
+        self.assertTrue('differs from setup scope session'
+                        in result.errors[0][1])
+        suite.teardown(result)
+        self.assertEqual(len(result.errors), 1)
+
+    def test_file_suite_02(self):
+        suite = ztest_nginx.FileSuite('a.zt', {'setup': '1 / 0'}, {})
+        result = unittest.TestResult()
+        self.assertFalse(suite.setup(result))
+        test, message = result.errors[0]
+        self.assertEqual(unittest.TextTestResult(None, True, 2)
+                         .getDescription(test), 'setup (a.zt)')
+        self.assertTrue('ZeroDivisionError' in message)
+
+
+class TestSocketReader(unittest.TestCase):
+    def reader(self, data):
+        a, b = socket.socketpair()
+        self.addCleanup(a.close)
+
+        def send():
+            b.sendall(data)
+            b.close()
+        sender = threading.Thread(target=send)
+        sender.start()
+        self.addCleanup(sender.join)
+        return ztest_nginx.SocketReader(a)
+
+    def test_socket_reader_00(self):
+        body = 'x' * (4 << 20)
+        reader = self.reader(
+            'POST /a HTTP/1.1\r\nContent-Length: %d\r\n\r\n%s'
+            'POST /b HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n'
+            '3\r\nabc\r\n2;x=y\r\nde\r\n0\r\n\r\n' % (len(body), body))
+        request = reader.read_request()
+        self.assertEqual((request.uri, request.body), ('/a', body))
+        request = reader.read_request()
+        self.assertEqual((request.uri, request.body), ('/b', 'abcde'))
+        self.assertEqual(reader.read_request(), None)
+        self.assertEqual(reader.size, 0)
+
+    def test_socket_reader_01(self):
+        reader = self.reader('GET / HTTP/1.1\r\nHost: a')
+        self.assertRaisesRegexp(IOError, 'closed in message head',
+                                reader.read_request)
+
+
+class TestMockUpstream(unittest.TestCase):
+    def test_mock_upstream_00(self):
+        specs = [{'body': str(i)} for i in range(32)]
+        upstream = ztest_nginx.MockUpstream('upstream', specs)
+        bodies = []
+
+        def receive(i):
+            bodies.append(upstream.receive(i)['body'])
+        threads = [threading.Thread(target=receive, args=(i,))
+                   for i in range(len(specs))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(sorted(bodies, key=int), [s['body'] for s in specs])
+        self.assertEqual(len(upstream.requests), len(specs))
+        self.assertEqual(upstream.receive(None)['body'], '31')
+
+
+class TestRenderConf(unittest.TestCase):
+    def render(self, template, servers):
+        saved = ztest_nginx.nginx_template
+        ztest_nginx.nginx_template = template
+        try:
+            return ztest_nginx.render_conf(servers)
+        finally:
+            ztest_nginx.nginx_template = saved
+
+    def test_render_conf_00(self):
+        api = ztest_nginx.nginx_api
+        conf = self.render('http {%(servers)s}', [
+            (api, 'location /a {}', False),
+            ('127.0.0.1:1991', 'location /b {}', False)])
+        self.assertEqual(conf.count('server {'), 2)
+        self.assertTrue('location /b {}' in conf)
+
+    def test_render_conf_01(self):
+        api = ztest_nginx.nginx_api
+        template = 'server { listen 1984; %(config)s }'
+        self.assertEqual(self.render(template, [(api, 'x', False)]),
+                         'server { listen 1984; x }')
+        for servers in [[(api, 'x', True)], [('127.0.0.1:1990', 'x', False)],
+                        [(api, 'x', False)] * 2]:
+            self.assertRaisesRegexp(Exception, 'need a %\\(servers\\)s',
+                                    self.render, template, servers)
+        self.assertRaisesRegexp(Exception, 'no %\\(servers\\)s',
+                                self.render, 'http {}', [(api, 'x', False)])
+
+
+class TestBeginRun(unittest.TestCase):
+    def test_begin_run_00(self):
+        value = 'location /t {}'
+        ztest_nginx.value_digest(value)
+        table = ztest_nginx.intern_table
+        table.value(value)
+        self.assertTrue(len(table) and ztest_nginx._digests)
+        ztest_nginx.begin_run()
+        self.assertEqual(len(table), 0)
+        self.assertEqual(ztest_nginx._digests, {})
+
+
+class TestUnixSocket(unittest.TestCase):
+    response = 'HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok'
+
+    def serve(self):
+        prefix = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, prefix)
+        api = ztest_nginx.unix_api(prefix)
+        self.addCleanup(shutil.rmtree, ztest_nginx.unix_dir(prefix))
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(api[len('unix:'):])
+        server.listen(1)
+        self.addCleanup(server.close)
+        requests = []
+
+        def handle():
+            conn, _ = server.accept()
+            request = ztest_nginx.SocketReader(conn).read_request()
+            requests.append(request)
+            conn.sendall(self.response)
+            conn.close()
+        thread = threading.Thread(target=handle)
+        thread.start()
+        self.addCleanup(thread.join)
+        return api, requests
+
+    def test_unix_socket_00(self):
+        api, requests = self.serve()
+        self.assertTrue(len(api) - len('unix:') <= ztest_nginx.unix_path_max)
+        conn = ztest_nginx.RawConnection(api)
+        self.addCleanup(conn.close)
+        conn.send('GET /t HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        self.assertEqual(conn.read_response().content, 'ok')
+        self.assertEqual(requests[0].uri, '/t')
+
+    @unittest.skipIf(not imports('requests'), 'requests is not installed')
+    def test_unix_socket_01(self):
+        api, requests = self.serve()
+        session = ztest_nginx.unix_session(api)
+        self.addCleanup(session.close)
+        r = session.get('http://127.0.0.1:1984/t',
+                        headers={'Host': '127.0.0.1:1984'})
+        self.assertEqual(r.content, 'ok')
+        self.assertEqual(requests[0].headers['host'], '127.0.0.1:1984')
+
+    def test_unix_socket_02(self):
+        prefix = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, prefix)
+        self.addCleanup(shutil.rmtree, ztest_nginx.unix_dir(prefix))
+        self.assertRaisesRegexp(Exception, 'longer than 107 bytes',
+                                ztest_nginx.unix_api, prefix, 'x' * 120)
+
+
+class TestRawExchange(unittest.TestCase):
+    response = 'HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok'
+
+    def connection(self, used=False):
+        a, b = socket.socketpair()
+        a.settimeout(0.2)
+        self.addCleanup(a.close)
+        self.addCleanup(b.close)
+        conn = ztest_nginx.RawConnection.__new__(ztest_nginx.RawConnection)
+        ztest_nginx.SocketReader.__init__(conn, a)
+        conn.used = used
+        return conn, b
+
+    def exchange(self, *conns):
+        t = ztest_nginx.TestNginx('test_run')
+        pool = list(conns)
+        t.raw_connection = lambda: pool.pop(0)
+        r = t.raw_exchange('GET / HTTP/1.1\r\n\r\n', ['GET'])
+        return r, pool
+
+    def test_raw_exchange_00(self):
+        # eof before the first byte of a reused connection
+        old, peer = self.connection(used=True)
+        peer.shutdown(socket.SHUT_WR)
+        new, server = self.connection()
+        server.sendall(self.response)
+        r, _ = self.exchange(old, new)
+        self.assertEqual(r[0].content, 'ok')
+        self.assertTrue(old.closed)
+
+    def test_raw_exchange_01(self):
+        # the send fails on a reused connection
+        old, peer = self.connection(used=True)
+        peer.close()
+        new, server = self.connection()
+        server.sendall(self.response)
+        r, _ = self.exchange(old, new)
+        self.assertEqual(r[0].content, 'ok')
+
+    def test_raw_exchange_02(self):
+        # a timeout and a truncated response are not retried, the spare
+        # connection would answer
+        spare, server = self.connection()
+        server.sendall(self.response)
+        old, peer = self.connection(used=True)
+        self.assertRaises(socket.timeout, self.exchange, old, spare)
+        self.assertTrue(old.closed)
+
+        old, peer = self.connection(used=True)
+        peer.sendall(self.response[:20])
+        peer.shutdown(socket.SHUT_WR)
+        self.assertRaisesRegexp(IOError, 'closed in message head',
+                                self.exchange, old, spare)
+
+    def test_raw_exchange_03(self):
+        # a fresh connection is never retried
+        spare, server = self.connection()
+        server.sendall(self.response)
+        new, peer = self.connection()
+        peer.shutdown(socket.SHUT_WR)
+        self.assertRaises(ztest_nginx.ConnectionClosed, self.exchange,
+                          new, spare)
+
+
 if __name__ == '__main__':
     unittest.main()
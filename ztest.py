@@ -12,12 +12,15 @@ from __future__ import print_function
 
 import re
 import os
+import copy
+import hashlib
 import unittest
 
 __version__ = '0.0.3'
 __author__ = 'Jinzheng Zhang <tianchaijz@gmail.com>'
 __all__ = [
-    'Pattern', 'Lexer', 'LexerException', 'Cases', 'ContextTestCase'
+    'Pattern', 'Lexer', 'LexerException', 'Cases', 'ContextTestCase',
+    'InternTable', 'Fragments', 'Case', 'Template', 'ContextSuite'
 ]
 
 
@@ -28,7 +31,7 @@ class Pattern(object):
     comment_pattern = r'^\s*//.*$'
     delimiter_pattern = '(?P<delimiter>__EOF__)$'
     case_line_pattern = r'^=== (TEST (\d+(\.\d+)?): ?(.+)?)$'
-    item_pattern = r'^--- (\w+) ?((?:\w+ ?)*)'
+    item_pattern = r'^--- (\w+) ?((?:\w+(?:=[^\s:]+)?(?![^\s:]) ?)*)'
     item_line_pattern = r'%s: (.+)$' % item_pattern
     item_head_pattern = r'%s$' % item_pattern
 
@@ -127,6 +130,16 @@ class Lexer(object):
     def get_item_option(s):
         return filter(lambda x: x != '', s.strip().split(' '))
 
+    @staticmethod
+    def get_option_value(option, key, default=None):
+        """ Return the value of a `key=value` item option.
+        """
+        prefix = key + '='
+        for o in option:
+            if o.startswith(prefix):
+                return o[len(prefix):]
+        return default
+
     def append(self, token):
         self.state = token.type
         token.lineno = self.blineno
@@ -246,6 +259,80 @@ class LexerException(Exception):
     pass
 
 
+class Fragments(object):
+    """ Resolve `--- include path` items and `include=path` options.
+        Included files hold items only, they are lexed once per content
+        and shared by every including file. Paths are relative to the
+        including file and tokens from a fragment keep its line numbers,
+        with the fragment path in `source`.
+    """
+    def __init__(self):
+        self.cache = {}
+
+    def load(self, path):
+        text = open(path).read()
+        digest = hashlib.sha1(text).hexdigest()
+        hit = self.cache.get(path)
+        if hit is not None and hit[0] == digest:
+            return hit[1]
+        try:
+            tokens = Lexer()(text)
+        except LexerException as e:
+            raise LexerException('%s: %s' % (path, e))
+        for token in tokens:
+            if token.type == Lexer.CASE_LINE:
+                raise LexerException('%s:%d: test case in an included file'
+                                     % (path, token.lineno))
+            token.source = path
+        self.cache[path] = (digest, tokens)
+        return tokens
+
+    def fragment(self, name, token, stack, deps):
+        path = os.path.normpath(os.path.join(os.path.dirname(stack[-1]),
+                                             name.strip()))
+        if os.path.abspath(path) in map(os.path.abspath, stack):
+            raise LexerException('include cycle: %s' % ' -> '.join(
+                stack + (path,)))
+        if not os.path.isfile(path):
+            raise LexerException('%s:%d: included file not found: %s' % (
+                getattr(token, 'source', stack[-1]), token.lineno, path))
+        if deps is not None and path not in deps:
+            deps.append(path)
+        return self.expand(self.load(path), path, stack, deps)
+
+    def expand(self, tokens, path, stack=(), deps=None):
+        """ Return `tokens` of the file at `path` with the includes
+            replaced, the paths of the included files go to `deps`.
+        """
+        stack = stack + (os.path.normpath(path),)
+        expanded = []
+        for token in tokens:
+            option = getattr(token, 'option', [])
+            target = Lexer.get_option_value(option, 'include')
+            if token.name == 'include':
+                for t in self.fragment(token.value or '', token, stack,
+                                       deps):
+                    t = copy.copy(t)
+                    t.type = token.type
+                    expanded.append(t)
+            elif target is not None:
+                values = [t.value for t in self.fragment(
+                    target, token, stack, deps) if t.name == token.name]
+                if not values:
+                    raise LexerException('%s:%d: no %s item in %s' % (
+                        getattr(token, 'source', stack[-1]), token.lineno,
+                        token.name, target))
+                token = copy.copy(token)
+                token.option = [o for o in option
+                                if not o.startswith('include=')]
+                token.value = '\n'.join(v for v in values + [token.value]
+                                        if v)
+                expanded.append(token)
+            else:
+                expanded.append(token)
+        return expanded
+
+
 class Case(object):
     def __init__(self, name, lineno, items):
         self.name = name
@@ -259,10 +346,96 @@ class Case(object):
         return self.__str__()
 
 
-class Cases(object):
+class Template(Case):
+    """ A case with a `--- matrix` item, a Python expression yielding
+        dicts of parameters. Every dict makes a case, with `{{key}}` in
+        the item values and the name replaced by the parameter. The
+        parameters the name does not mention are appended to it as
+        key=value, so every case gets a distinct name. The cases are
+        generated one at a time, the expression is evaluated again for
+        every pass.
+    """
+    placeholder = re.compile(r'\{\{(\w+)\}\}')
+
+    def __init__(self, name, lineno, items, matrix):
+        super(Template, self).__init__(name, lineno, items)
+        self.matrix = matrix
+
+    def params(self, namespace=None):
+        return eval(self.matrix.value, {} if namespace is None else namespace)
+
+    def render(self, text, params):
+        if not isinstance(text, basestring) or '{{' not in text:
+            return text
+        return self.placeholder.sub(
+            lambda m: str(params[m.group(1)]) if m.group(1) in params
+            else m.group(0), text)
+
+    def case_name(self, params):
+        name = self.name or ''
+        named = set(self.placeholder.findall(name))
+        return ' '.join(([self.render(name, params)] if name else []) + [
+            '%s=%s' % (k, params[k]) for k in sorted(params)
+            if k not in named])
+
+    def names(self, namespace=None):
+        for params in self.params(namespace):
+            yield self.case_name(params)
+
+    def expand(self, select=None, namespace=None):
+        """ Generate the cases whose name passes `select`.
+        """
+        for params in self.params(namespace):
+            name = self.case_name(params)
+            if select is not None and not select(name):
+                continue
+            items = []
+            for item in self.items:
+                item = copy.copy(item)
+                item.value = self.render(item.value, params)
+                items.append(item)
+            yield Case(name, self.lineno, items)
+
+
+class InternTable(object):
+    """ Content-addressed table of item values and options, identical ones
+        parsed anywhere share one object and compare by identity.
+    """
     def __init__(self):
+        self.values = {}
+        self.options = {}
+
+    def __len__(self):
+        return len(self.values) + len(self.options)
+
+    def value(self, v):
+        if not isinstance(v, basestring):
+            return v
+        return self.values.setdefault(v, v)
+
+    def option(self, o):
+        return self.options.setdefault(tuple(o), o)
+
+    def intern(self, token):
+        token.value = self.value(token.value)
+        if hasattr(token, 'option'):
+            token.option = self.option(token.option)
+        return token
+
+    def clear(self):
+        self.values.clear()
+        self.options.clear()
+
+
+intern_table = InternTable()
+
+
+class Cases(object):
+    def __init__(self, table=None):
         self.globals = {}
+        self.options = {}
         self.cases = []
+        self.table = intern_table if table is None else table
 
     def __call__(self, tokens):
         self.parse(tokens)
@@ -271,35 +444,88 @@ class Cases(object):
     def parse(self, tokens):
         name, lineno, items = None, 0, []
         for token in tokens:
+            self.table.intern(token)
             if token.type == Lexer.GLOBAL:
                 self.globals[token.name] = token.value
+                self.options[token.name] = getattr(token, 'option', [])
             if token.type == Lexer.ITEM:
                 items.append(token)
             if token.type == Lexer.CASE_LINE:
                 if items:
-                    self.cases.append(Case(name, lineno, items))
+                    self.cases.append(self.make_case(name, lineno, items))
                     items = []
                 name, lineno = token.name, token.lineno
         if items:
-            self.cases.append(Case(name, lineno, items))
+            self.cases.append(self.make_case(name, lineno, items))
+
+    @staticmethod
+    def make_case(name, lineno, items):
+        matrix = [i for i in items if i.name == 'matrix']
+        if not matrix:
+            return Case(name, lineno, items)
+        if len(matrix) > 1:
+            raise LexerException('more than one matrix in case at line: %d'
+                                 % lineno)
+        return Template(name, lineno, [i for i in items if i is not matrix[0]],
+                        matrix[0])
 
 
 class ContextTestCase(unittest.TestCase):
     """ TestCase classes that want a context should
         inherit from this class.
     """
+    test_names = {}
+
     def __init__(self, methodName='runTest', ctx=None):
         super(ContextTestCase, self).__init__(methodName)
         self.ctx = ctx
 
+    def __eq__(self, other):
+        if type(self) is not type(other):
+            return NotImplemented
+        return self._testMethodName == other._testMethodName and \
+            self.ctx is other.ctx
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((type(self), self._testMethodName, id(self.ctx)))
+
     @staticmethod
     def addContext(testClass, ctx=None):
         """ Create a suite containing all tests taken from the given
             subclass, passing them the context.
         """
-        loader = unittest.TestLoader()
-        cases = loader.getTestCaseNames(testClass)
+        names = ContextTestCase.test_names.get(testClass)
+        if names is None:
+            names = ContextTestCase.test_names[testClass] = \
+                unittest.TestLoader().getTestCaseNames(testClass)
         suite = unittest.TestSuite()
-        for case in cases:
-            suite.addTest(testClass(case, ctx=ctx))
+        for name in names:
+            suite.addTest(testClass(name, ctx=ctx))
         return suite
+
+
+class ContextSuite(unittest.TestSuite):
+    """ Tests of one method of a ContextTestCase class, one per context,
+        each created when the suite is first iterated up to it.
+    """
+    def __init__(self, testClass, methodName='runTest', contexts=()):
+        super(ContextSuite, self).__init__()
+        self.testClass = testClass
+        self.methodName = methodName
+        self._tests.extend(contexts)
+
+    def addContext(self, ctx):
+        self._tests.append(ctx)
+
+    def __iter__(self):
+        for idx, test in enumerate(self._tests):
+            if not isinstance(test, unittest.TestCase):
+                test = self._tests[idx] = self.testClass(self.methodName,
+                                                         ctx=test)
+            yield test
+
+    def countTestCases(self):
+        return len(self._tests)